@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+'''
+Cold start benchmark for the patchtester command line.
+
+Times "python -m patchtester --help" and a dry planning run
+("--dry_run -i ...", no P4 connection) in fresh interpreters and compares
+the medians with startup_baseline.json next to this script. Exits non zero
+when a command got slower than the baseline by more than the tolerance, when
+--help imports one of the heavy dependencies, or when there is no baseline
+to compare with.
+
+    python benchmarks/bench_startup.py -t 24.1 -f 24.0           # check
+    python benchmarks/bench_startup.py -t 24.1 -f 24.0 --update  # baseline
+
+The dry run needs release names known to the release catalog; without -t
+and -f only --help is measured.
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'startup_baseline.json')
+
+# modules that only the code paths using them may load
+HEAVY = ('P4', 'jinja2', 'anytree', 'yaml', 'smtplib', 'email.mime')
+
+
+def run(args, importtime=False):
+    """
+        runs the cli once in a fresh interpreter
+        @param args: command line arguments for patchtester
+        @param importtime: run with -X importtime
+        @returns: (seconds, stderr)
+    """
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    command += ['-m', 'patchtester'] + args
+    start = time.perf_counter()
+    proc = subprocess.run(command, cwd=ROOT, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    seconds = time.perf_counter() - start
+    if proc.returncode:
+        sys.exit('patchtester {0} failed:\n{1}'.format(' '.join(args),
+                                                        proc.stderr))
+    return seconds, proc.stderr
+
+
+def heavy_imports(stderr):
+    """
+        returns the heavy modules listed in -X importtime output
+        @param stderr: stderr of an importtime run
+    """
+    found = set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        module = line.rsplit('|', 1)[-1].strip()
+        for heavy in HEAVY:
+            if module == heavy or module.startswith(heavy + '.'):
+                found.add(heavy)
+    return sorted(found)
+
+
+def measure(commands, repeat):
+    """
+        returns the median seconds of each command
+        @param commands: {name: patchtester arguments}
+        @param repeat: runs per command
+    """
+    return {name: statistics.median(run(args)[0] for _ in range(repeat))
+            for name, args in commands.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-t', '--target',
+                        help='release to target in the dry run',
+                        required=False)
+    parser.add_argument('-f', '--branch_from',
+                        help='release the dry run changes come from',
+                        required=False)
+    parser.add_argument('-r', '--repeat',
+                        type=int,
+                        default=7,
+                        help='runs per command, the median is compared',
+                        required=False)
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=0.25,
+                        help='allowed slowdown over the baseline (fraction)',
+                        required=False)
+    parser.add_argument('--update',
+                        action='store_true',
+                        help='write the measured times as the new baseline',
+                        required=False)
+    args = parser.parse_args()
+
+    commands = {'help': ['--help']}
+    if args.target and args.branch_from:
+        commands['dry_run'] = ['-t', args.target, '-f', args.branch_from,
+                               '-c', 'bench', '-n', '-i', '1001,1002,1003']
+
+    failed = False
+    loaded = heavy_imports(run(commands['help'], importtime=True)[1])
+    if loaded:
+        print('--help imports ' + ', '.join(loaded))
+        failed = True
+
+    times = measure(commands, args.repeat)
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+    elif not args.update:
+        print('no baseline at {0}, run with --update to write it'
+              .format(BASELINE))
+        return 1
+    if args.update:
+        baseline.update(times)
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('baseline written to ' + BASELINE)
+
+    for name, seconds in sorted(times.items()):
+        if name not in baseline:
+            print('{0:10} {1:8.3f}s  no baseline, run with --update'.format(
+                  name, seconds))
+            failed = True
+            continue
+        limit = baseline[name] * (1 + args.tolerance)
+        status = 'ok' if seconds <= limit else 'REGRESSION'
+        print('{0:10} {1:8.3f}s  limit {2:8.3f}s  {3}'.format(
+              name, seconds, limit, status))
+        failed = failed or seconds > limit
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,18 +1,141 @@
 '''
 patchTester will evaluate pending patch requests for a branch.
 '''
-from anytree import node, search
-from jinja2 import Environment, FileSystemLoader
-
+from collections import OrderedDict
+import functools
 import logging
 from termutils import AskYesNo
 import sys
 import os
-import P4
+import re
+import threading
+import time
+
+from patchtester.components import ComponentMap
+from patchtester.diffs import DiffCache
+from patchtester.lazy import LazyModule
+from patchtester.metrics import RunMetrics
+from patchtester.p4policy import CommandPolicy, CommandTimeout
+from patchtester.scheduler import RunBudget, risk_order
+
+# heavy dependencies are imported on first use
+P4 = LazyModule('P4')
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
 _logger = logging.getLogger(os.path.basename(sys.argv[0]))
 
+# files listed in a cross component warning
+CROSS_COMPONENT_FILES = 20
+
+# characters of details shown before they are collapsed in the report
+COLLAPSE_OVER = 1000
+
+# pre-screen verdicts
+PRESCREEN_CLEAN = 'trivially clean'
+PRESCREEN_RESOLVE = 'needs resolve'
+PRESCREEN_UNKNOWN = 'unknown'
+
+# risk added by the pre-screen verdict of a change, None when not screened
+PRESCREEN_RISK = {PRESCREEN_CLEAN: 0.0, PRESCREEN_RESOLVE: 1.0,
+                  PRESCREEN_UNKNOWN: 0.5, None: 0.5}
+
+# revisions of a target file looked at for edits since the last integration
+TARGET_EDITS_LIMIT = 20
+
+# reported results of streamed changes kept for later requests of a change
+OUTCOME_CACHE = 1000
+
+# descriptions of intervening edits kept for conflict suggestions
+DESCRIBE_CACHE = 1000
+
+
+@functools.lru_cache(maxsize=None)
+def _template():
+    """
+        returns the report template, compiled once per process
+    """
+    from jinja2 import Environment, FileSystemLoader
+
+    # jinja html template
+    script_dir = os.path.join(os.path.dirname(__file__), 'data')
+    env = Environment(loader=FileSystemLoader(searchpath=script_dir))
+    return env.get_template('email_notify.tmpl')
+
+
+class _ComponentIndex(object):
+    """
+    Report rows grouped by the components the changes touch, filled in
+    while the requests stream through the template.
+    """
+    def __init__(self):
+        self._rows = {}
+
+    def add(self, req, chg):
+        components = chg.get('components') or []
+        for component, owner in components:
+            rows = self._rows.setdefault((component, owner), [])
+            rows.append(dict(req_id=req['req_id'],
+                             orig_change=chg['orig_change'],
+                             result=chg['result'],
+                             crosscomponent=len(components) > 1))
+
+    def groups(self):
+        return [(component, owner, self._rows[(component, owner)])
+                for component, owner in sorted(self._rows,
+                                               key=lambda key: key[0])]
+
+
+def stream_report(requests, from_prefix, to_prefix):
+    """
+        yields the html report of a target branch in chunks. Requests may
+        be any iterable; each one is rendered as it is consumed.
+
+        @param requests: results from PatchTester.iterResults
+        @param from_prefix: the branch the changes are integrated from
+        @param to_prefix: the target branch
+    """
+    components = _ComponentIndex()
+
+    def indexed():
+        for req in requests:
+            for chg in req['changes']:
+                components.add(req, chg)
+            yield req
+
+    subject = "<b>from " + from_prefix + " to " + to_prefix + "</b>"
+    # element ids must stay unique when several branches share a mail
+    anchor = re.sub(r'[^A-Za-z0-9_.-]+', '-', to_prefix).strip('-')
+    return _template().generate(title='patchTester Report',
+                                subject=subject,
+                                anchor=anchor,
+                                results=indexed(),
+                                components=components,
+                                collapse_over=COLLAPSE_OVER)
+
+
+def write_report(handle, requests, from_prefix, to_prefix):
+    """
+        writes the html report of a target branch to a file handle
+
+        @param handle: the open file
+        @param requests: results from PatchTester.iterResults
+        @param from_prefix: the branch the changes are integrated from
+        @param to_prefix: the target branch
+    """
+    for chunk in stream_report(requests, from_prefix, to_prefix):
+        handle.write(chunk)
+
+
+def render_report(requests, from_prefix, to_prefix):
+    """
+        renders collected results of a target branch as html
+
+        @param requests: results from PatchTester.collectResults
+        @param from_prefix: the branch the changes are integrated from
+        @param to_prefix: the target branch
+    """
+    return ''.join(stream_report(requests, from_prefix, to_prefix))
+
 
 class PatchTester(object):
     """
@@ -21,8 +144,47 @@ class PatchTester(object):
     def __init__(self, data, DEBUG):
         self.pt_data = data 
         self.p4 = data.p4
+        self.workers = getattr(data, 'workers', 4)
+        self.conflicts = []  # conflicts waiting on analyzeConflicts
+        self._describes = OrderedDict()  # describes of intervening edits
+        self._describes_lock = threading.Lock()
+        self._local = threading.local()
+        self._connections = []
+        self.clean = set()  # changes the pre-screen found trivially clean
+        self.metrics = getattr(data, 'metrics', None) or RunMetrics()
+        self.policy = getattr(data, 'policy', None) or CommandPolicy()
+        self.components = getattr(data, 'components', None) or ComponentMap()
+        self.budget = getattr(data, 'budget', None) or RunBudget()
+        self.history = getattr(data, 'history', None)
+        self.streaming = False  # set by the streaming pipeline
+        # changes integrated by integrateRequest: (request, result) once
+        # they were reported
+        self.tested = {}
+        self.outcomes = OrderedDict()  # the latest reported results
+        self._planned = {}  # summary describes of the requested changes
+        self._request_nodes = {}  # requested change: its nodes
+        self._change_nodes = {}  # test changelist: the nodes integrated in it
+        self.indexNodes()
+        self.diffs = None  # diffs are only loaded for the report
+        if getattr(data, 'report_diffs', False):
+            self.diffs = DiffCache(self.p4, getattr(data, 'diff_cache_bytes',
+                                                    16 * 1024 * 1024))
         _logger.setLevel(logging.DEBUG if DEBUG else logging.INFO)
 
+    def _run(self, *args, p4=None):
+        """
+            runs a p4 command under the command policy, counting it in the
+            run metrics
+
+            @param args: the command and its arguments, or a list of them
+            @param p4: the connection to use, defaults to self.p4
+        """
+        command = args[0]
+        if isinstance(command, (list, tuple)):
+            command = command[0]
+        self.metrics.countCommand(command)
+        return self.policy.run(p4 or self.p4, args)
+
     def prepForIntegration(self): # NOQA - complexity accepted
         """
             prepares the client to do the integrations.
@@ -38,7 +200,7 @@ class PatchTester(object):
                 # get all opens for this client, test to see if they are
                 # to destination if so ask to shelve them and revert
                 pending = False
-                pending_changes = self.p4.run("opened")
+                pending_changes = self._run("opened")
                 if pending_changes:
                     # see if these are pending to the target branch
                     for pendch in pending_changes:
@@ -69,36 +231,36 @@ class PatchTester(object):
                                                              " changelist")
                                 # the input to this updated change
                                 self.p4.input = new_change
-                                new_change = self.p4.run('change', '-i')
+                                new_change = self._run('change', '-i')
                                 # see if was made, bail if not
                                 results = new_change[0].split(' ')
                                 if results[0] == "Change" and \
                                    results[2] == "created":
                                     change_id = results[1]
                                     # shelve all files in this new change
-                                    self.p4.run("shelve",
-                                                "-c",
-                                                change_id,
-                                                "-f",
-                                                "-a",
-                                                "submitunchanged")
+                                    self._run("shelve",
+                                              "-c",
+                                              change_id,
+                                              "-f",
+                                              "-a",
+                                              "submitunchanged")
                                 else:
                                     _logger.error('Error creating'
                                                   ' numbered change')
                                     sys.exit(1)
                             else:  # shelve all files for this changelist
                                 change_id = pending_change['change']
-                                self.p4.run("shelve",
-                                            "-c",
-                                            change_id,
-                                            "-f",
-                                            "-a",
-                                            "submitunchanged")
+                                self._run("shelve",
+                                          "-c",
+                                          change_id,
+                                          "-f",
+                                          "-a",
+                                          "submitunchanged")
 
                         #  Now revert all open files across all open changelists
                         _logger.info('Reverting all open files')
-                        self.p4.run("revert", "//...")
-            except P4.P4Exception as e:
+                        self._run("revert", "//...")
+            except (P4.P4Exception, CommandTimeout) as e:
                 _logger.error('Error ' + str(e))
                 sys.exit(1)
 
@@ -109,267 +271,1116 @@ class PatchTester(object):
                 try:
                     # No Pending changes now, so we should sync
                     _logger.debug('p4 sync ...')
-                    self.p4.run("sync", self.pt_data.branches[0]['p4_to_prefix'] + "/...")
-                except P4.P4Exception as e:
+                    self._run("sync", self.pt_data.branches[0]['p4_to_prefix'] + "/...")
+                except (P4.P4Exception, CommandTimeout) as e:
                     if 'file(s) up-to-date.' in str(e):
                         _logger.debug('Tree up-to-date')
                     else:
                         _logger.error('Error ' + str(e))
                         sys.exit(1)
 
-    def doIntegrations(self):  # NOQA - complexity accepted
+    def preScreen(self):  # NOQA - complexity accepted
+        """
+            classifies the requested changes from integration metadata only.
+
+            A change is trivially clean when every file it touches is new to
+            the target branch or the head revision of the target file is an
+            exact copy of the previous requested revision.  It definitely
+            needs a resolve when the target file has been edited since it was
+            last integrated.  Trivially clean changes are skipped by
+            doIntegrations, the verdict of every change is kept on its nodes
+            for the report.  On a higher branch the original change of a
+            test changelist is screened again.
+        """
+        self.clean = set()
+        for integrate in self.pt_data.requested_integrates:
+            if int(integrate) == 0:
+                continue
+            integrate_nodes = self._changeNodes(integrate)
+            if not integrate_nodes:
+                continue
+            for integrate_node in integrate_nodes:
+                integrate_node.prescreen = None
+                integrate_node.prescreen_reason = None
+            self._screenNodes(integrate_nodes[0].req_change, integrate_nodes,
+                              key=integrate)
+
+        _logger.info("\nPre-screen found {} of {} changes trivially clean"
+                     .format(len(self.clean),
+                             len(self.pt_data.requested_integrates)))
+
+    def _screenNodes(self, integrate, integrate_nodes, p4=None, key=None):
+        """
+            stores the pre-screen verdict of a change on its nodes
+
+            @param integrate: the requested change
+            @param integrate_nodes: the nodes requesting the change
+            @param p4: the connection to use, defaults to self.p4
+            @param key: the entry of requested_integrates a clean change is
+                        recorded under, defaults to integrate
+        """
+        try:
+            with self.policy.scope(integrate):
+                verdict, reason = self._screenChange(integrate, p4)
+        except CommandTimeout as e:
+            verdict, reason = PRESCREEN_UNKNOWN, str(e)
+        _logger.debug("pre-screen {} {}: {}".format(integrate, verdict,
+                                                    reason))
+        for integrate_node in integrate_nodes:
+            integrate_node.prescreen = verdict
+            integrate_node.prescreen_reason = reason
+            if verdict == PRESCREEN_CLEAN:
+                self._initNode(integrate_node)
+        if verdict == PRESCREEN_CLEAN:
+            self.clean.add(str(integrate if key is None else key))
+
+    def _screenChange(self, integrate, p4=None):  # NOQA - complexity accepted
+        """
+            returns the pre-screen verdict and reason for a change
+
+            @param integrate: the requested change
+            @param p4: the connection to use, defaults to self.p4
+        """
+        p4 = p4 or self.p4
+        try:
+            change_desc = self._describeChange(integrate, p4)
+        except P4.P4Exception as e:
+            return PRESCREEN_UNKNOWN, str(e)
+
+        from_prefix = self.pt_data.p4_from_prefix + '/'
+        to_prefix = self.pt_data.branches[0]['p4_to_prefix'] + '/'
+        wanted = {}
+        for file, rev, action in zip(change_desc.get('depotFile', []),
+                                     change_desc.get('rev', []),
+                                     change_desc.get('action', [])):
+            if not file.startswith(from_prefix):
+                continue
+            if 'delete' in action:
+                return PRESCREEN_UNKNOWN, file + ' is deleted'
+            wanted[to_prefix + file[len(from_prefix):]] = (file, int(rev))
+        if not wanted:
+            return PRESCREEN_UNKNOWN, 'no files in ' + from_prefix
+
+        try:
+            with p4.at_exception_level(P4.P4.RAISE_ERRORS):
+                filelogs = self._run(['filelog', '-m1'] + sorted(wanted),
+                                     p4=p4)
+        except P4.P4Exception as e:
+            return PRESCREEN_UNKNOWN, str(e)
+
+        verdict = PRESCREEN_CLEAN
+        reason = 'target files are unchanged since last integrated'
+        found = set()
+        for filelog in filelogs:
+            if type(filelog) is not dict or 'depotFile' not in filelog:
+                continue
+            target = filelog['depotFile']
+            found.add(target)
+            if target not in wanted:
+                continue
+            source, rev = wanted[target]
+            hows = filelog.get('how', [[]])[0] or []
+            files = filelog.get('file', [[]])[0] or []
+            erevs = filelog.get('erev', [[]])[0] or []
+            if not hows:
+                # head revision was not integrated, it is a local edit
+                return (PRESCREEN_RESOLVE,
+                        target + ' edited in target since last integrated')
+            copied = False
+            for how, file, erev in zip(hows, files, erevs):
+                if (how in ('copy from', 'branch from') and file == source and
+                        int(erev.replace('#', '')) == rev - 1):
+                    copied = True
+                    break
+            if not copied:
+                verdict = PRESCREEN_UNKNOWN
+                reason = target + ' head is a merge or from another revision'
+
+        for target in wanted:
+            if target not in found and wanted[target][1] != 1:
+                # file is missing in target though it is not new in source
+                verdict = PRESCREEN_UNKNOWN
+                reason = target + ' does not exist in target'
+        return verdict, reason
+
+    def doIntegrations(self):
         """
-            Carries out the integrations and resolutions
+            Carries out the integrations and resolutions.
+
+            With a failure limit or a time budget the riskiest changes are
+            integrated first and testing stops once the budget is exhausted,
+            the changes left are reported as skipped.
         """
-        seen_nodes = []
+        self._seen_nodes = []
+        order = range(len(self.pt_data.requested_integrates))
+        if self.budget.limited():
+            with self.metrics.phase('schedule',
+                                    self.pt_data.branches[0]['name']):
+                order = self.scheduleChanges()
+        for n in order:
+            self._testChange(n, self.pt_data.requested_integrates[n])
+
+    def scheduleChanges(self):  # NOQA - complexity accepted
+        """
+            returns the indexes of requested_integrates riskiest first.
+
+            The risk of a change adds up its pre-screen verdict, the edits
+            made in the target branch to its files since they were last
+            integrated from the source branch and, with a results history,
+            how often its files failed before and whether it failed the last
+            time it was tested.  Requests without a change go first as they
+            fail at once, pre-screened clean changes go last.
+        """
+        from_prefix = self.pt_data.p4_from_prefix + '/'
+        to_prefix = self.pt_data.branches[0]['p4_to_prefix'] + '/'
+        risks = []
+        files = []
+        tested = {}  # index: the original change
         for n, integrate in enumerate(self.pt_data.requested_integrates):
-            # if change is number zero then it is tbd or it was not set in
-            # the PRQ
-            if (int(integrate) is 0):
-                key = 'Pending patch or missing Requested Changelists: field'
-                desc = 'No changelist available.'
-                sug = ('This request depends on a request to the originating'
-                       ' branch that has not been done yet or it has a PRQ '
-                       ' that is missing the requested changelist. '
-                       ' Try again later or fix the changelist.')
-                integrate_nodes = search.findall_by_attr(self.pt_data, value=0)
-                for integrate_node in integrate_nodes:
-                    if integrate_node not in seen_nodes:
-                        integrate_node.crosscomponent = False
-                        integrate_node.errors = []    # store errors
-                        integrate_node.sugs = []
-                        integrate_node.errors.append({key: desc})
-                        integrate_node.sugs.append({key: sug})
-                        _logger.debug(key + "\n" + desc)
-                        seen_nodes.append(integrate_node)
+            risks.append(0.0)
+            files.append([])
+            if int(integrate) == 0:
+                risks[n] = float('inf')
+                continue
+            integrate_nodes = self._changeNodes(integrate)
+            if not integrate_nodes or str(integrate) in self.clean:
                 continue
+            change = integrate_nodes[0].req_change
+            risks[n] = PRESCREEN_RISK.get(getattr(integrate_nodes[0],
+                                                  'prescreen', None),
+                                          PRESCREEN_RISK[None])
+            try:
+                with self.policy.scope(change):
+                    change_desc = self._describeChange(change)
+                    files[n] = [to_prefix + file[len(from_prefix):]
+                                for file in change_desc.get('depotFile', [])
+                                if file.startswith(from_prefix)]
+                    edits = self._targetEdits(files[n])
+            except (P4.P4Exception, CommandTimeout) as e:
+                _logger.debug('could not rate ' + str(change) + ' ' + str(e))
+                continue
+            risks[n] += edits / (edits + 1.0)
+            tested[n] = change
 
-            # find this child in our tree of requested integrations
-            integrate_node = search.find_by_attr(self.pt_data,
-                                                 value=str(integrate))
-            if not integrate_node:
-                # no node for this implies that this is local integrate to higher branches
-                # process special
-
-                _logger.debug("no integrate node for this integrate searching for parent")
-                integrate_node = search.find_by_attr(self.pt_data,
-                                                     name="change",
-                                                     value=str(integrate))
-
-                if integrate_node:
-                    _logger.debug("parent found, replacing change to integrate with original")
-                    integrate_node.change = integrate_node.change_desc['change']
-                    integrate = integrate_node.change_desc['change']
-
-            if integrate_node:
-                integrate_node.crosscomponent = False
-                integrate_node.errors = []    # store errors
-                integrate_node.warnings = []  # store warnings
-                integrate_node.sugs = []      # store warnings
-                _logger.info("\n\n" + "=" * 80)
-                _logger.info("Change {0} for {1}"
-                             .format(integrate, integrate_node.parent.req_id))
-                # add details of the original change to our the node for this
-                # change
-                try:
-                    integrate_node.change_desc = self.p4.run('describe',
-                                                             int(integrate))[0]
-                except P4.P4Exception as e:
-                    key = 'p4 describe integrate error'
+        if self.history:
+            branch = self.pt_data.branches[0]['name']
+            rates = self.history.failureRates(
+                branch, set(file for n in tested for file in files[n]))
+            failed = self.history.lastFailed(branch, tested.values())
+            for n, change in tested.items():
+                risks[n] += max([rates.get(file, 0.0) for file in files[n]] +
+                                [0.0])
+                risks[n] += 1.0 if failed.get(str(change)) else 0.0
+
+        order = risk_order(risks, files)
+        _logger.info("\nScheduled {} changes riskiest first".format(len(order)))
+        for n in order:
+            _logger.debug("risk {:.2f} {}".format(
+                          risks[n], self.pt_data.requested_integrates[n]))
+        return order
+
+    def _targetEdits(self, targets):
+        """
+            returns the number of revisions made to target files since they
+            were last integrated from the source branch, counting at most
+            TARGET_EDITS_LIMIT per file
+
+            @param targets: the target depot files of a change
+        """
+        if not targets:
+            return 0
+        from_prefix = self.pt_data.p4_from_prefix + '/'
+        with self.p4.at_exception_level(P4.P4.RAISE_ERRORS):
+            filelogs = self._run(['filelog', '-m', str(TARGET_EDITS_LIMIT)] +
+                                 targets)
+        edits = 0
+        for filelog in filelogs:
+            if type(filelog) is not dict or 'depotFile' not in filelog:
+                continue
+            hows = filelog.get('how') or []
+            sources = filelog.get('file') or []
+            for rev in range(len(filelog.get('rev', []))):
+                how = (hows[rev] if rev < len(hows) else None) or []
+                source = (sources[rev] if rev < len(sources) else None) or []
+                if any(h.endswith(' from') and f.startswith(from_prefix)
+                       for h, f in zip(how, source)):
+                    break
+                edits += 1
+        return edits
+
+    def _testChange(self, n, integrate):
+        """
+            integrates a change unless the run budget is exhausted, counting
+            it against the budget when it failed
+
+            @param n: the index of the change in requested_integrates
+            @param integrate: the requested change
+        """
+        if self._skipped(integrate):
+            return
+        self._integrateChange(n, integrate)
+        integrate_nodes = self._changeNodes(integrate)
+        if integrate_nodes and self._failed(integrate_nodes[0]):
+            self.budget.failed()
+
+    def _skipped(self, integrate, integrate_nodes=None):
+        """
+            marks the nodes of a change skipped once the run budget is
+            exhausted, returning whether it was
+
+            @param integrate: the requested change
+            @param integrate_nodes: the nodes of the change, looked up in
+                                    the tree if None
+        """
+        reason = self.budget.exhausted()
+        if reason is None or str(integrate) in self.clean:
+            return False
+        self.budget.stopped = reason
+        if integrate_nodes is None:
+            integrate_nodes = self._changeNodes(integrate)
+        for integrate_node in integrate_nodes:
+            self._initNode(integrate_node)
+            integrate_node.skipped = reason
+        return True
+
+    @staticmethod
+    def _failed(integrate_node):
+        """
+            returns whether a tested change is reported as failed
+
+            @param integrate_node: the node of the change
+        """
+        errors = getattr(integrate_node, 'errors', [])
+        if errors:
+            return not integrate_node.crosscomponent
+        return bool(getattr(integrate_node, 'warnings', []))
+
+    def doBatchIntegrations(self, batch_size=100):  # NOQA - complexity accepted
+        """
+            Carries out the integrations and resolutions in batches.
+
+            Requested changes that do not touch any of the same files are
+            grouped and integrated into one shared test changelist, which is
+            then described and resolved once.  Conflicts are mapped back to
+            the requested change that brought the file in.  Changes that
+            overlap with every group are integrated one at a time as in
+            doIntegrations.
+
+            @param batch_size: the maximum number of changes in a group
+        """
+        self._seen_nodes = []
+        groups = []  # [set of depot files, [(n, integrate, node), ...]]
+        singles = []
+        fan_outs = []  # nodes that requested the same change
+        for n, integrate in enumerate(self.pt_data.requested_integrates):
+            if str(integrate) in self.clean:
+                continue
+            if int(integrate) == 0:
+                singles.append((n, integrate))
+                continue
+
+            integrate_nodes = self._requestNodes(integrate)
+            if not integrate_nodes:
+                # local integrate to higher branches, process special
+                singles.append((n, integrate))
+                continue
+
+            integrate_node = integrate_nodes[0]
+            fan_outs.append(integrate_nodes)
+            self._initNode(integrate_node)
+            try:
+                with self.policy.scope(integrate):
+                    integrate_node.change_desc = self._describeChange(integrate)
+            except CommandTimeout as e:
+                self._timedOut(integrate_node, e)
+                continue
+            except P4.P4Exception as e:
+                key = 'p4 describe integrate error'
+                desc = str(e)
+                integrate_node.errors.append({key: desc})
+                _logger.debug(key + "\n" + desc)
+                continue
+
+            files = set(integrate_node.change_desc.get('depotFile', []))
+            for group in groups:
+                if len(group[1]) < batch_size and group[0].isdisjoint(files):
+                    group[0].update(files)
+                    group[1].append((n, integrate, integrate_node))
+                    break
+            else:
+                groups.append([files, [(n, integrate, integrate_node)]])
+
+        for files, members in groups:
+            if len(members) == 1:
+                singles.append(members[0][:2])
+                continue
+            if self.budget.exhausted():
+                for member in members:
+                    self._skipped(member[1])
+                continue
+            started = time.time()
+            try:
+                self._integrateBatch(members)
+            except CommandTimeout as e:
+                # a command shared by the whole batch timed out
+                for n, integrate, integrate_node in members:
+                    self._timedOut(integrate_node, e)
+            # the batch shares its commands, split its time evenly
+            elapsed = (time.time() - started) / len(members)
+            for n, integrate, integrate_node in members:
+                integrate_node.elapsed = elapsed
+                if self._failed(integrate_node):
+                    self.budget.failed()
+            self.metrics.maybeWrite()
+
+        for integrate_nodes in fan_outs:
+            self._fanOut(integrate_nodes)
+
+        for n, integrate in sorted(singles, key=lambda s: s[0]):
+            self._testChange(n, integrate)
+
+    def _initNode(self, integrate_node):
+        """
+            resets the result data kept on a change node
+        """
+        integrate_node.crosscomponent = False
+        integrate_node.errors = []    # store errors
+        integrate_node.warnings = []  # store warnings
+        integrate_node.sugs = []      # store suggestions
+        integrate_node.conflict_files = []
+        integrate_node.skipped = None  # why the change was not tested
+
+    def _createChange(self, description):
+        """
+            creates a pending changelist returning its number or None
+
+            @param description: the description of the new changelist
+        """
+        new_change = self.p4.fetch_change()
+        new_change['description'] = description
+        self.p4.input = new_change
+        new_change = self._run('change', '-i')
+
+        results = new_change[0].split(' ')
+        if not results[0] == "Change" and not results[2] == "created":
+            return None
+        self.pt_data.created_changelists.append(results[1])
+        return results[1]
+
+    def _integrateBatch(self, members):  # NOQA - complexity accepted
+        """
+            integrates a group of non overlapping changes into one changelist
+
+            @param members: list of (index, integrate, node) tuples
+        """
+        changes = [str(integrate) for n, integrate, node in members]
+        _logger.info("\n\n" + "=" * 80)
+        _logger.info("Batch of changes {0}".format(", ".join(changes)))
+
+        batch_change = self._createChange("patchTester: test batch integrate"
+                                          " for {}".format(", ".join(changes)))
+        if batch_change is None:
+            for n, integrate, integrate_node in members:
+                key = 'create new change error'
+                desc = 'Failed to create batch changelist'
+                integrate_node.errors.append({key: desc})
+            return
+
+        # index of requested depot files to the change that brought them in
+        file_index = {}
+        integrated = []
+        for n, integrate, integrate_node in members:
+            _logger.info("Change {0} for {1}"
+                         .format(integrate, integrate_node.parent.req_id))
+            self._setChange(integrate_node, batch_change)
+            integrate_cmd = ['integ', '-q', '-c', batch_change, '-f',
+                             self.pt_data.p4_from_prefix + '/...@' +
+                             str(integrate) + ',' + str(integrate),
+                             self.pt_data.branches[0]['p4_to_prefix'] + '/...']
+            _logger.debug(" ".join(integrate_cmd))
+            try:
+                with self.policy.scope(integrate):
+                    warn = self._run(integrate_cmd)
+                if warn:
+                    key = 'p4 integration warning'
+                    desc = str(warn)
+                    integrate_node.warnings.append({key: desc})
+                    _logger.info(key + "\n" + desc)
+            except CommandTimeout as e:
+                self._timedOut(integrate_node, e)
+                continue
+            except P4.P4Exception as e:
+                key = 'p4 integrate error'
+                desc = str(e)
+                sug = self.suggestFix(desc, integrate_node)
+                integrate_node.errors.append({key: desc})
+                _logger.info(key + "\n" + desc)
+                integrate_node.sugs.append({key: sug})
+                continue
+
+            integrated.append(integrate_node)
+            for idx, file in enumerate(integrate_node.change_desc['depotFile']):
+                file_index[file] = (integrate_node, idx)
+
+        if not integrated:
+            return
+
+        # the commands shared by the batch also stop at the run deadline
+        try:
+            with self.policy.scope(batch_change):
+                res_result = self._resolveBatch(batch_change, integrated)
+        except CommandTimeout as e:
+            for integrate_node in integrated:
+                self._timedOut(integrate_node, e)
+            return
+        if res_result is None:
+            return
+
+        failed = set()
+        current = None
+        for reslt in res_result:
+            if type(reslt) is dict:
+                current = reslt
+                continue
+            if type(reslt) is not str or current is None:
+                continue
+            con = self._resolveConflict(reslt)
+            if con is None:
+                continue
+            from_file = current.get('fromFile', '')
+            if from_file not in file_index:
+                _logger.debug("conflict in unrequested file " + from_file)
+                continue
+            integrate_node, idx = file_index[from_file]
+            file = from_file.replace(self.pt_data.p4_from_prefix,
+                                     self.pt_data.branches[0]['p4_to_prefix'],
+                                     1)
+            integrate_node.res_result = [current]
+            key = 'Resolution Conflict'
+            error = con + ' reported for file ' + file + "\n\n"
+            integrate_node.errors.append({key: error})
+            self._deferConflict(key, integrate_node, file, idx)
+            _logger.debug(error)
+            failed.add(integrate_node)
+
+        for integrate_node in integrated:
+            if integrate_node not in failed:
+                self._checkCrossComponent(integrate_node)
+
+    def _resolveBatch(self, batch_change, integrated):
+        """
+            syncs and resolves the files opened in a batch changelist
+            returning the resolve results or None if no files were opened
+
+            @param batch_change: the batch changelist
+            @param integrated: the nodes of the changes integrated into it
+        """
+        pending_chg = self._run('describe', '-s', batch_change)[0]
+        if 'depotFile' not in list(pending_chg.keys()):
+            for integrate_node in integrated:
+                key = 'Failed to copy in files to new changelist'
+                desc = 'No files were opened in batch change ' + batch_change
+                integrate_node.warnings.append({key: desc})
+                _logger.debug(key + "\n" + desc)
+            return None
+
+        # sync the opened files in one pass before resolving them together
+        try:
+            sync_result = self._run(['sync', '-q'] + pending_chg['depotFile'])
+            _logger.debug("sync_result (empty good)" + str(sync_result))
+        except P4.P4Exception as e:
+            _logger.info("sync error")
+            _logger.info(str(e))
+
+        resolve_cmd = ['resolve', '-am', '-o', '-c', batch_change]
+        _logger.debug(" ".join(resolve_cmd))
+        try:
+            with self.metrics.phase('resolve', self.pt_data.branches[0]['name']):
+                res_result = self._run(resolve_cmd)
+        except P4.P4Exception as e:
+            res_result = []
+            if 'no file(s) to resolve.' not in str(e):
+                for integrate_node in integrated:
+                    key = 'p4 resolve error'
                     desc = str(e)
                     integrate_node.errors.append({key: desc})
-                    _logger.debug(key + "\n" + desc)
-                    continue
+                _logger.info("error resolving files")
+                _logger.info(str(e))
+        return res_result
 
-                # create a changelist for the integration
-                new_change = self.p4.fetch_change()
-                new_change['description'] = ("patchTester: test integrate"
-                                             " for {} original desc: {}".
-                                             format(str(integrate),
-                                                    integrate_node.
-                                                    change_desc['desc']))
-                self.p4.input = new_change
-                new_change = self.p4.run('change', '-i')
-
-                # see if was made, go to next if not
-                results = new_change[0].split(' ')
-                if not results[0] == "Change" and not results[2] == "created":
-                    key = 'create new change error'
-                    desc = str(new_change)
-                    integrate_node.errors.append({key: desc})
-                    _logger.debug(key + "\n" + desc)
-                    continue
+    def _resolveConflict(self, reslt):
+        """
+            returns the conflict count text of a resolve message or None
 
-                # The new changelist number
-                integrate_node.change = results[1]
-                self.pt_data.created_changelists.append(integrate_node.change)
+            @param reslt: a string result of p4 resolve -o
+        """
+        if 'Diff chunks:' in reslt and ' 0 conflicting' not in reslt:
+            return reslt.split('+')[-1].replace('conflicting', 'conflicts')
+        return None
 
-                _logger.info("Integrating change {} as local change {}".
-                             format(integrate, integrate_node.change))
-                # cook new integration command
-                integrate_cmd = ['integ', '-q', '-c', integrate_node.change, '-f',
-                                 self.pt_data.p4_from_prefix + '/...@' +
-                                 str(integrate) + ',' + str(integrate),
-                                 self.pt_data.branches[0]['p4_to_prefix'] + '/...']
-                _logger.debug(" ".join(integrate_cmd))
+    def _checkCrossComponent(self, integrate_node):
+        """
+            flags a change whose files span multiple components
 
-                # do the integration
-                try:
-                    warn = self.p4.run(integrate_cmd)
-                    if warn:
-                        # data was returned!
-                        # meaning it had something to warn about
-                        key = 'p4 integration warning'
-                        desc = str(warn)
-                        integrate_node.warnings.append({key: desc})
-                        _logger.info(key + "\n" + desc)
-                except P4.P4Exception as e:
-                    key = 'p4 integrate error'
+            @param integrate_node: the node of a cleanly resolved change
+        """
+        components = getattr(integrate_node, 'components', None)
+        if components is None:
+            components = self._components(integrate_node.change_desc)
+        _logger.debug('components ' + ', '.join(components))
+        if len(components) > 1:
+            # found cross component, raise flag
+            integrate_node.crosscomponent = True
+            key = 'Cross Component Checkin'
+            error = ("Succcesfully integrated and resolved but \n" +
+                     "this changelist contains files from multiple components: " +
+                     ", ".join(components))
+            files = integrate_node.change_desc['depotFile']
+            sug = ("This is a warning. \n" +
+                   "These are the files in this changelist\n" +
+                   str("\n".join(files[:CROSS_COMPONENT_FILES])))
+            if len(files) > CROSS_COMPONENT_FILES:
+                sug += "\n... and {} more files".format(
+                    len(files) - CROSS_COMPONENT_FILES)
+            integrate_node.errors.append({key: error})
+            integrate_node.sugs.append({key: sug})
+
+    def _components(self, change_desc):
+        """
+            returns the sorted components of the files of a change
+
+            @param change_desc: the describe of the change
+        """
+        return sorted(self.components.components(change_desc.get('depotFile', []),
+                                                 self.pt_data.p4_from_prefix))
+
+    def _describeChange(self, integrate, p4=None):
+        """
+            returns the summary describe of a requested change, described
+            only once per run
+
+            @param integrate: the requested change
+            @param p4: the connection to use, defaults to self.p4
+        """
+        change_desc = self._planned.get(str(integrate))
+        if change_desc is None:
+            change_desc = self._run('describe', '-s', int(integrate), p4=p4)[0]
+            self._planned[str(integrate)] = change_desc
+        return change_desc
+
+    def planChanges(self):
+        """
+            describes every requested change once and classifies its files
+            into components, so every change, failed or not, has its
+            component set for the cross component check and the report.
+        """
+        for integrate in self.pt_data.requested_integrates:
+            if int(integrate) == 0:
+                continue
+            integrate_nodes = self._requestNodes(integrate)
+            if integrate_nodes:
+                self._planChange(integrate, integrate_nodes)
+
+    def _planChange(self, integrate, integrate_nodes, p4=None):
+        """
+            describes a change and stores its components on its nodes
+
+            @param integrate: the requested change
+            @param integrate_nodes: the nodes requesting the change
+            @param p4: the connection to use, defaults to self.p4
+        """
+        try:
+            with self.policy.scope(integrate):
+                change_desc = self._describeChange(integrate, p4)
+        except (P4.P4Exception, CommandTimeout) as e:
+            # reported when the change is integrated
+            _logger.debug('could not plan ' + str(integrate) + ' ' + str(e))
+            return
+        components = self._components(change_desc)
+        for integrate_node in integrate_nodes:
+            integrate_node.components = components
+
+    def _integrateChange(self, n, integrate):  # NOQA - complexity accepted
+        """
+            integrates and resolves a single requested change
+
+            @param n: the index of the change in requested_integrates
+            @param integrate: the requested change
+        """
+        if str(integrate) in self.clean:
+            _logger.debug("pre-screened clean, skipping " + str(integrate))
+            return
+
+        # if change is number zero then it is tbd or it was not set in
+        # the PRQ
+        if (int(integrate) == 0):
+            integrate_nodes = self._requestNodes(0)
+            for integrate_node in integrate_nodes:
+                if integrate_node not in self._seen_nodes:
+                    self._noChange(integrate_node)
+                    self._seen_nodes.append(integrate_node)
+            return
+
+        # find the children in our tree that requested this integration
+        integrate_nodes = self._requestNodes(integrate)
+        if not integrate_nodes:
+            # no node for this implies that this is local integrate to higher branches
+            # process special
+
+            _logger.debug("no integrate node for this integrate searching for parent")
+            integrate_nodes = list(self._change_nodes.get(str(integrate),
+                                                          []))
+
+            if integrate_nodes:
+                _logger.debug("parent found, replacing change to integrate with original")
+                integrate = integrate_nodes[0].change_desc['change']
+                for integrate_node in integrate_nodes:
+                    self._setChange(integrate_node, integrate)
+
+        if not integrate_nodes:
+            return
+
+        self._timedIntegrate(n, integrate, integrate_nodes[0])
+        self._fanOut(integrate_nodes)
+        self.metrics.maybeWrite()
+
+    def _noChange(self, integrate_node):
+        """
+            records that a request has no change to test
+
+            @param integrate_node: the node with change 0
+        """
+        key = 'Pending patch or missing Requested Changelists: field'
+        desc = 'No changelist available.'
+        sug = ('This request depends on a request to the originating'
+               ' branch that has not been done yet or it has a PRQ '
+               ' that is missing the requested changelist. '
+               ' Try again later or fix the changelist.')
+        self._initNode(integrate_node)
+        integrate_node.errors.append({key: desc})
+        integrate_node.sugs.append({key: sug})
+        _logger.debug(key + "\n" + desc)
+
+    def _timedIntegrate(self, n, integrate, integrate_node):
+        """
+            integrates a change under the command policy, timing it
+
+            @param n: the index of the change in requested_integrates
+            @param integrate: the requested change
+            @param integrate_node: the node the results are stored on
+        """
+        started = time.time()
+        try:
+            with self.policy.scope(integrate):
+                self._integrateNode(n, integrate, integrate_node)
+        except CommandTimeout as e:
+            self._timedOut(integrate_node, e)
+        integrate_node.elapsed = time.time() - started
+
+    def _timedOut(self, integrate_node, error):
+        """
+            records that testing a change was given up on after a timeout
+
+            @param integrate_node: the node of the change
+            @param error: the CommandTimeout
+        """
+        if self.budget.expired():
+            # cut short by the deadline of the run, not a fault of the change
+            self._initNode(integrate_node)
+            integrate_node.skipped = self.budget.stopped = \
+                self.budget.exhausted()
+            self.policy.open_circuits.discard(error.change)
+            _logger.info("change {} interrupted, {}".format(
+                         error.change, integrate_node.skipped))
+            return
+        key = 'p4 command timeout'
+        sug = ('Testing of this change was stopped, ' + str(error) + '. '
+               'The change may contain very large files or the server was '
+               'overloaded. Please test it by hand or retry later.')
+        integrate_node.errors.append({key: str(error)})
+        integrate_node.sugs.append({key: sug})
+        _logger.info(key + "\n" + str(error))
+
+    def indexNodes(self):
+        """
+            indexes the change nodes of the request tree by the change they
+            request, once the tree is built or sharded
+        """
+        self._request_nodes = {}
+        self._change_nodes = {}
+        for request in self.pt_data.children:
+            for integrate_node in request.children:
+                self._request_nodes.setdefault(
+                    str(integrate_node.name), []).append(integrate_node)
+                if getattr(integrate_node, 'change', None) is not None:
+                    self._change_nodes.setdefault(
+                        str(integrate_node.change), []).append(integrate_node)
+
+    def _setChange(self, integrate_node, change):
+        """
+            stores the test changelist of a node, keeping _changeNodes
+            current
+
+            @param integrate_node: the change node
+            @param change: the changelist the change is integrated in
+        """
+        old = getattr(integrate_node, 'change', None)
+        if old is not None:
+            nodes = self._change_nodes.get(str(old), [])
+            if integrate_node in nodes:
+                nodes.remove(integrate_node)
+        integrate_node.change = change
+        self._change_nodes.setdefault(str(change), []).append(integrate_node)
+
+    def _requestNodes(self, integrate):
+        """
+            returns every node of the tree that requested a change
+
+            @param integrate: the requested change
+        """
+        return list(self._request_nodes.get(str(integrate), []))
+
+    def _changeNodes(self, integrate):
+        """
+            returns the nodes of a change, also when it was replaced by its
+            test changelist to integrate to a higher branch
+
+            @param integrate: the requested or test change
+        """
+        return (self._requestNodes(integrate) or
+                list(self._change_nodes.get(str(integrate), [])))
+
+    def _fanOut(self, integrate_nodes):
+        """
+            copies the result of the first node to the other nodes
+            requesting the same change
+
+            @param integrate_nodes: the nodes requesting one change
+        """
+        tested = integrate_nodes[0]
+        for integrate_node in integrate_nodes[1:]:
+            if getattr(tested, 'change', None) is not None:
+                self._setChange(integrate_node, tested.change)
+            for attr in ('crosscomponent', 'change_desc',
+                         'res_result', 'elapsed', 'skipped'):
+                if hasattr(tested, attr):
+                    setattr(integrate_node, attr, getattr(tested, attr))
+            for attr in ('errors', 'warnings', 'sugs', 'conflict_files'):
+                if hasattr(tested, attr):
+                    setattr(integrate_node, attr, list(getattr(tested, attr)))
+
+    def _integrateNode(self, n, integrate, integrate_node):  # NOQA - complexity accepted
+        """
+            integrates and resolves a change for the node that requested it
+
+            @param n: the index of the change in requested_integrates, None
+                      when the change is not in the list
+            @param integrate: the requested change
+            @param integrate_node: the node the results are stored on
+        """
+        self._initNode(integrate_node)
+        _logger.info("\n\n" + "=" * 80)
+        _logger.info("Change {0} for {1}"
+                     .format(integrate, integrate_node.parent.req_id))
+        # add details of the original change to our the node for this
+        # change
+        try:
+            integrate_node.change_desc = self._describeChange(integrate)
+        except P4.P4Exception as e:
+            key = 'p4 describe integrate error'
+            desc = str(e)
+            integrate_node.errors.append({key: desc})
+            _logger.debug(key + "\n" + desc)
+            return
+
+        # create a changelist for the integration
+        new_change = self._createChange("patchTester: test integrate"
+                                        " for {} original desc: {}".
+                                        format(str(integrate),
+                                               integrate_node.
+                                               change_desc['desc']))
+
+        # see if was made, go to next if not
+        if new_change is None:
+            key = 'create new change error'
+            desc = 'Failed to create changelist'
+            integrate_node.errors.append({key: desc})
+            _logger.debug(key + "\n" + desc)
+            return
+
+        # The new changelist number
+        self._setChange(integrate_node, new_change)
+
+        _logger.info("Integrating change {} as local change {}".
+                     format(integrate, integrate_node.change))
+        # cook new integration command
+        integrate_cmd = ['integ', '-q', '-c', integrate_node.change, '-f',
+                         self.pt_data.p4_from_prefix + '/...@' +
+                         str(integrate) + ',' + str(integrate),
+                         self.pt_data.branches[0]['p4_to_prefix'] + '/...']
+        _logger.debug(" ".join(integrate_cmd))
+
+        # do the integration
+        try:
+            warn = self._run(integrate_cmd)
+            if warn:
+                # data was returned!
+                # meaning it had something to warn about
+                key = 'p4 integration warning'
+                desc = str(warn)
+                integrate_node.warnings.append({key: desc})
+                _logger.info(key + "\n" + desc)
+        except P4.P4Exception as e:
+            key = 'p4 integrate error'
+            desc = str(e)
+            sug = self.suggestFix(desc, integrate_node)
+            integrate_node.errors.append({key: desc})
+            _logger.info(key + "\n" + desc)
+            integrate_node.sugs.append({key: sug})
+            _logger.debug("\n" + sug)
+            return
+
+        pending_chg = self._run('describe', '-s', integrate_node.change)[0]
+        if 'depotFile' not in list(pending_chg.keys()):
+            key = 'Failed to copy in files to new changelist'
+            desc = ('A file integration failed. Multiple requests '
+                    'contained different revisions of the same file.')
+            sug = ('This warning indicates that the same file was '
+                   'requested in multiple changelists. Because '
+                   'PatchTester does not submit the files like '
+                   'p4 patch does, it can not integrate multiple '
+                   'revisions of the same file. Therefore, it '
+                   'only integrates the first one. This means '
+                   'that PatchTester is not really testing all '
+                   'of the requested changes to that file.')
+            integrate_node.warnings.append({key: desc})
+            _logger.debug(key + "\n" + desc)
+            integrate_node.sugs.append({key: sug})
+            return
+
+        reslt_failed = False
+
+        for idx, file in enumerate(pending_chg['depotFile']):
+            # if its file add (rev 1) and branching skip resolve
+            if (int(pending_chg['rev'][idx]) == 1 and
+                    'branch' in str(pending_chg['action'][idx])):
+                _logger.debug("File branch rev 1, skipping " + file)
+                continue
+            try:
+                _logger.info("\n" + str(file))
+                verify_cmd = ['verify', '-q', '-s', file]
+                _logger.debug(" ".join(verify_cmd))
+                verify_result = self._run(verify_cmd)
+                _logger.debug("verify_result (empty good)" + str(verify_result))
+
+                sync_cmd = ['sync', '-q', file]
+                _logger.debug(" ".join(sync_cmd))
+                sync_result = self._run(sync_cmd)
+                _logger.debug("sync_result (empty good)" + str(sync_result))
+            except P4.P4Exception as e:
+                _logger.info("verify/sync error")
+                _logger.info(str(e))
+
+            try:
+                resolve_cmd = ['resolve', '-am', '-o', file]
+                _logger.debug(" ".join(resolve_cmd))
+                integrate_node.res_result = None
+                with self.metrics.phase('resolve',
+                                        self.pt_data.branches[0]['name']):
+                    integrate_node.res_result = self._run(resolve_cmd)
+            except P4.P4Exception as e:
+                if 'no file(s) to resolve.' not in str(e):
+                    key = 'p4 resolve error'
                     desc = str(e)
-                    sug = self.suggestFix(desc, integrate_node)
                     integrate_node.errors.append({key: desc})
+                    _logger.info("error resolving files")
                     _logger.info(key + "\n" + desc)
-                    integrate_node.sugs.append({key: sug})
-                    _logger.debug("\n" + sug)
-                    continue
 
-                pending_chg = self.p4.run('describe', integrate_node.change)[0]
-                if 'depotFile' not in list(pending_chg.keys()):
-                    key = 'Failed to copy in files to new changelist'
-                    desc = ('A file integration failed. Multiple requests '
-                            'contained different revisions of the same file.')
-                    sug = ('This warning indicates that the same file was '
-                           'requested in multiple changelists. Because '
-                           'PatchTester does not submit the files like '
-                           'p4 patch does, it can not integrate multiple '
-                           'revisions of the same file. Therefore, it '
-                           'only integrates the first one. This means '
-                           'that PatchTester is not really testing all '
-                           'of the requested changes to that file.')
-                    integrate_node.warnings.append({key: desc})
-                    _logger.debug(key + "\n" + desc)
-                    integrate_node.sugs.append({key: sug})
-                    continue
+            if integrate_node.res_result:
+                result_string = ""
+                for reslt in integrate_node.res_result:
+                    if type(reslt) is dict:
+                        if 'contentResolveType' in reslt:
+                            result_string += "contentResolveType:" + reslt['contentResolveType']
+                        if 'baseRev' in reslt:
+                            result_string += "\nbaseRev:" + reslt['baseRev']
+                        if 'how' in reslt:
+                            result_string += "\nhow:" + reslt['how']
+                    if type(reslt) is str:
+                        result_string += "\n" + reslt
+                        _logger.info(reslt)
+                        if 'resolve skipped.' in reslt:
+                            # no resolution
+                            break
+                        con = self._resolveConflict(reslt)
+                        if con is not None:
+                            key = 'Resolution Conflict'
+                            error = (con + ' reported for file ' +
+                                     file + "\n\n")
+                            integrate_node.errors \
+                                          .append({key: error})
+                            self._deferConflict(key, integrate_node,
+                                                file, idx)
+                            _logger.debug(error)
+                            reslt_failed = True
+                            break
 
-                reslt_failed = False
+                _logger.debug(result_string)
+            else:
+                key = 'Error resolving ' + file
+                desc = 'Failed to resolve'
+                integrate_node.errors.append({key: desc})
+                _logger.debug(key + "\n" + desc)
 
-                for idx, file in enumerate(pending_chg['depotFile']):
-                    # if its file add (rev 1) and branching skip resolve
-                    if (int(pending_chg['rev'][idx]) == 1 and
-                            'branch' in str(pending_chg['action'][idx])):
-                        _logger.debug("File branch rev 1, skipping " + file)
-                        continue
-                    try:
-                        _logger.info("\n" + str(file))
-                        verify_cmd = ['verify', '-q', '-s', file]
-                        _logger.debug(" ".join(verify_cmd))
-                        verify_result = self.p4.run(verify_cmd)
-                        _logger.debug("verify_result (empty good)" + str(verify_result))
-
-                        sync_cmd = ['sync', '-q', file]
-                        _logger.debug(" ".join(sync_cmd))
-                        sync_result = self.p4.run(sync_cmd)
-                        _logger.debug("sync_result (empty good)" + str(sync_result))
-                    except P4.P4Exception as e:
-                        _logger.info("verify/sync error")
-                        _logger.info(str(e))
+        if not reslt_failed:
+            self._checkCrossComponent(integrate_node)
 
-                    try:
-                        resolve_cmd = ['resolve', '-am', '-o', file]
-                        _logger.debug(" ".join(resolve_cmd))
-                        integrate_node.res_result = None
-                        integrate_node.res_result = self.p4.run(resolve_cmd)
-                    except P4.P4Exception as e:
-                        if 'no file(s) to resolve.' not in str(e):
-                            key = 'p4 resolve error'
-                            desc = str(e)
-                            integrate_node.errors.append({key: desc})
-                            _logger.info("error resolving files")
-                            _logger.info(key + "\n" + desc)
-
-                    if integrate_node.res_result:
-                        result_string = ""
-                        for reslt in integrate_node.res_result:
-                            if type(reslt) is dict:
-                                if 'contentResolveType' in reslt:
-                                    result_string += "contentResolveType:" + reslt['contentResolveType']
-                                if 'baseRev' in reslt:
-                                    result_string += "\nbaseRev:" + reslt['baseRev']
-                                if 'how' in reslt:
-                                    result_string += "\nhow:" + reslt['how']
-                            if type(reslt) is str:
-                                result_string += "\n" + reslt
-                                _logger.info(reslt)
-                                if 'resolve skipped.' in reslt:
-                                    # no resolution
-                                    break
-                                elif 'Diff chunks:' in reslt:
-                                    if ' 0 conflicting' not in reslt:
-                                        con = reslt.split('+')[-1] \
-                                                   .replace('conflicting',
-                                                            'conflicts')
-                                        key = 'Resolution Conflict'
-                                        error = (con + ' reported for file ' +
-                                                 file + "\n\n")
-                                        sug = self.suggestFix('resolutionConf',
-                                                              integrate_node,
-                                                              file, idx)
-                                        integrate_node.errors \
-                                                      .append({key: error})
-                                        integrate_node.sugs.append({key: sug})
-                                        _logger.debug(error)
-                                        reslt_failed = True
-                                        break
-
-                        _logger.debug(result_string)
-                    else:
-                        key = 'Error resolving ' + file
-                        desc = 'Failed to resolve'
-                        integrate_node.errors.append({key: desc})
-                        _logger.debug(key + "\n" + desc)
-
-                if not reslt_failed:
-                    compare_to = None
-                    for file in integrate_node.change_desc['depotFile']:
-                        component = file.replace(self.pt_data.p4_from_prefix + '/', '').split('/')[0]
-                        _logger.debug('component compared ' + component)
-
-                        # skip the following "components"
-                        if 'testSpecs' in component:
-                            continue
-                        elif 'SCons' in component:
-                            continue
-                        elif 'buildMap' in component:
-                            continue
-
-                        if not compare_to:
-                            compare_to = component
-                            continue
-                        if compare_to != component:
-                            _logger.debug('components do not match')
-                            # found cross component, raise flag
-                            integrate_node.crosscomponent = True
-                            key = 'Cross Component Checkin'
-                            error = ("Succcesfully integrated and resolved but \n" +
-                                     "this changelist contains files from multiple components.")
-                            sug = ("This is a warning. \n" +
-                                   "These are the files in this changelist\n" +
-                                   str("\n".join(integrate_node.change_desc['depotFile'])))
-                            integrate_node.errors.append({key: error})
-                            integrate_node.sugs.append({key: sug})
-                            break
+        # update self.pt_data.requested_integrates with new pending change id
+        # in case we wish to integrate this change to higher branches.
+        if n is not None:
+            self.pt_data.requested_integrates[n] = integrate_node.change
+
+    def _deferConflict(self, key, node, file, idx):
+        """
+            queues a resolution conflict for analyzeConflicts; the
+            suggestion is filled in once the analysis has run.
+
+            @param key: the error key the suggestion is stored under
+            @param node: the node with the conflicting change
+            @param file: the conflicting target depot file
+            @param idx: the index of the file in the requested change
+        """
+        sug = {key: None}
+        node.sugs.append(sug)
+        node.conflict_files.append(file)
+        self.conflicts.append((file, node, idx, node.res_result, sug))
+
+    def analyzeConflicts(self):
+        """
+            runs suggestFix for all conflicts found by the integration pass.
+
+            The have revisions of every conflicting file are fetched in one
+            command, the filelog and describe queries then run on a small
+            pool of worker connections.
+        """
+        conflicts, self.conflicts = self.conflicts, []
+        if not conflicts:
+            return
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._local = threading.local()
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+                self.suggestConflicts(conflicts, pool)
+        finally:
+            self.closeWorkers()
+
+    def suggestConflicts(self, conflicts, pool, p4=None):
+        """
+            fills in the suggestions of conflicts on a pool of analysis
+            workers
+
+            @param conflicts: the conflicts queued by _deferConflict
+            @param pool: the executor the analysis runs on
+            @param p4: the connection the have revisions are fetched with,
+                       defaults to self.p4
+        """
+        _logger.info("\nAnalyzing {} conflicts".format(len(conflicts)))
+        haves = {}
+        try:
+            files = sorted(set(conflict[0] for conflict in conflicts))
+            for have in self._run(['have'] + files, p4=p4):
+                if type(have) is dict:
+                    haves[have['depotFile']] = have['haveRev']
+        except P4.P4Exception as e:
+            # suggestFix reports the files it can not find
+            _logger.debug("have error " + str(e))
+        except CommandTimeout as e:
+            # each worker runs its own have for the files missing here
+            _logger.warning("have of the conflicting files stopped, "
+                            + str(e))
+
+        def analyze(conflict):
+            file, node, idx, res_result, sug = conflict
+            if self.budget.expired():
+                return ("Analysis of this conflict was skipped, the"
+                        " --time_budget was spent.")
+            try:
+                with self.policy.scope(node.req_change):
+                    return self.suggestFix('resolutionConf', node, file, idx,
+                                           res_result=res_result,
+                                           have=haves.get(file),
+                                           p4=self.workerP4())
+            except CommandTimeout as e:
+                return "Analysis of this conflict was stopped, " + str(e)
+            except P4.P4Exception as e:
+                _logger.debug("failed to be able to divine missing changes")
+                return "Please have a look at this change" + str(e)
 
-                # update self.pt_data.requested_integrates with new pending change id
-                # in case we wish to integrate this change to higher branches.
-                self.pt_data.requested_integrates[n] = integrate_node.change
+        for conflict, sug in zip(conflicts, pool.map(analyze, conflicts)):
+            key = list(conflict[4].keys())[0]
+            conflict[4][key] = sug
+            _logger.debug("\n" + sug)
 
-    def suggestFix(self, error, node, file=None, idx=0): # NOQA - complexity accepted
+    def closeWorkers(self):
+        """
+            disconnects the connections opened by workerP4
+        """
+        connections, self._connections = self._connections, []
+        for p4 in connections:
+            p4.disconnect()
+
+    def workerP4(self):
+        """
+            returns the connection of the calling thread; analysis workers
+            share self.p4 with a single worker unless the run is streamed,
+            where self.p4 is busy integrating
+        """
+        if self.workers <= 1 and not self.streaming:
+            return self.p4
+        p4 = getattr(self._local, 'p4', None)
+        if p4 is None:
+            p4 = P4.P4(client=self.p4.client, port=self.p4.port,
+                       user=self.p4.user)
+            p4.connect()
+            self._connections.append(p4)
+            self._local.p4 = p4
+        return p4
+
+    def _describeEdit(self, p4, edit):
+        """
+            returns the (cached) description of an intervening edit
+
+            @param p4: the connection to use
+            @param edit: the change number
+        """
+        with self._describes_lock:
+            if edit in self._describes:
+                self._describes.move_to_end(edit)
+                return self._describes[edit]
+        desc = self._run('describe', '-s', int(edit), p4=p4)[0]['desc']
+        with self._describes_lock:
+            self._describes[edit] = desc
+            if len(self._describes) > DESCRIBE_CACHE:
+                self._describes.popitem(last=False)
+        return desc
+
+    def suggestFix(self, error, node, file=None, idx=0, res_result=None,  # NOQA - complexity accepted
+                   have=None, p4=None):
         '''
             giant switch statement for gathering of known conditions
 
             @param error: the string used for look up
             @param node: the node with the change having issues.
+            @param file: the conflicting target depot file
+            @param idx: the index of the file in the requested change
+            @param res_result: the resolve result of the file
+            @param have: the have revision of the file if already known
+            @param p4: the connection to use, defaults to self.p4
         '''
+        p4 = p4 or self.p4
+        res_result = res_result or node.res_result
         sug = '.' * 120 + '\n'
         if 'Warnings during command execution( "p4 integ -q -c' in error:
             if '- no such file' in error:
@@ -384,11 +1395,19 @@ class PatchTester(object):
                             ' currently at : ' + node.change_desc['path'] +
                             '\nWe need it to be in this branch: ' +
                             self.pt_data.p4_from_prefix + '\n')
+                    catalog = getattr(self.pt_data, 'catalog', None)
+                    release = catalog and catalog.GetReleaseByPath(
+                        node.change_desc['path'])
+                    if release is not None:
+                        sug += ('It was submitted to release ' +
+                                release.release_name + ' (' +
+                                release.version + ')\n')
                     return sug
         elif 'resolutionConf' in error:  # resolution conflict
             # get the revision number we have for this file
             try:
-                have = self.p4.run('have', file)[0]['haveRev']
+                if have is None:
+                    have = self._run('have', file, p4=p4)[0]['haveRev']
             except P4.P4Exception as e:
                 _logger.debug("failed to be able to divine missing changes")
                 sug = "Please have a look at this change"
@@ -401,11 +1420,11 @@ class PatchTester(object):
             want = node.change_desc['rev'][idx]
 
             # get the basefile used in resolution
-            base_file = node.res_result[0]['baseFile']
+            base_file = res_result[0]['baseFile']
 
             # get the filelog of the file we have at the rev we have
             cmd = ['filelog', '-h', '-m2', file + '#' + have + ',#' + have]
-            have_hist = self.p4.run(cmd)
+            have_hist = self._run(cmd, p4=p4)
             edits = []
             minusrev = 0
             if have_hist:
@@ -425,7 +1444,7 @@ class PatchTester(object):
                         cmd = ['filelog', '-h', '-m2', file + '#' +
                                str(newhave) + ',#' + str(newhave)]
                         _logger.debug("looking for new have " + " ".join(cmd))
-                        new_hist = self.p4.run(cmd)
+                        new_hist = self._run(cmd, p4=p4)
                         if 'file' in list(new_hist[0].keys()):
                             break
 
@@ -474,8 +1493,7 @@ class PatchTester(object):
                     genesis += ("<ul style=\"margin-top:-30px"
                                 ";margin-bottom:-60px\">")
                     for edit in edits:
-                        change_desc = self.p4.run('describe', int(edit))[0]
-                        description = change_desc['desc'].splitlines(True)
+                        description = self._describeEdit(p4, edit).splitlines(True)
                         genesis += ("<li>Change: " + str(edit) +
                                     " \nDescription:\n" +
                                     " ".join(description[0:4]) + "</li>")
@@ -504,7 +1522,7 @@ class PatchTester(object):
                             'missing intervening revisions to properly'
                             ' resolve this file. Perhaps the following diff'
                             ' command can help:')
-                    sug += ('\"p4 diff2 ' + node.res_result[0]['clientFile'] +
+                    sug += ('\"p4 diff2 ' + res_result[0]['clientFile'] +
                             ' ' + base_file + '#' + want + '\"\n\n')
                 else:
                     have_plus = int(rev) + 1
@@ -513,7 +1531,7 @@ class PatchTester(object):
                     cmd = ['filelog', base_file + '#' + str(have_plus) +
                            ',#' + want]
                     try:
-                        want_hist = self.p4.run(cmd)
+                        want_hist = self._run(cmd, p4=p4)
                     except P4.P4Exception as e:
                         _logger.debug("failed to be able to divine missing changes")
                         sug = "Please have a look at this change"
@@ -544,78 +1562,253 @@ class PatchTester(object):
             sug += ("\n\n")
         return sug
 
-    def generateReport(self):
+    def planRequest(self, request, prescreen=False, p4=None):
+        """
+            describes, and optionally pre-screens, the changes of a request
+            for the streaming pipeline
+
+            @param request: the request node
+            @param prescreen: classify the changes as preScreen does
+            @param p4: the connection to use, defaults to self.p4
+        """
+        for integrate_node in request.children:
+            integrate = integrate_node.req_change
+            if int(integrate) == 0 or str(integrate) in self.tested:
+                continue
+            self._planChange(integrate, [integrate_node], p4)
+            if prescreen:
+                self._screenNodes(integrate, [integrate_node], p4)
+
+    def integrateRequest(self, request):
+        """
+            tests the changes of a request for the streaming pipeline and
+            returns the conflicts found for suggestConflicts.  A change
+            already tested for an earlier request is only marked as a
+            duplicate, its result is copied when the request is reported.
+
+            @param request: the request node
+        """
+        try:
+            for integrate_node in request.children:
+                integrate = str(integrate_node.req_change)
+                if integrate in self.tested:
+                    integrate_node.duplicate = True
+                    continue
+                integrate_node.duplicate = False
+                self.tested[integrate] = None
+                self._testNode(integrate_node)
+        finally:
+            # a failed request leaves no conflicts to the next one
+            conflicts, self.conflicts = self.conflicts, []
+        return conflicts
+
+    def failRequest(self, request, error):
+        """
+            records an error that stopped the streaming of a request on its
+            changes, the later stages pass the request on untouched.  The
+            conflicts whose analysis did not run say so.
+
+            @param request: the request node
+            @param error: the exception
+        """
+        request.stream_error = str(error)
+        key = 'patchtester error'
+        sug = ('Testing of this request was stopped by an unexpected error.'
+               ' Please retry it or report the error.')
+        for integrate_node in request.children:
+            if getattr(integrate_node, 'duplicate', False):
+                # the result is copied from the request that tested it
+                continue
+            if not hasattr(integrate_node, 'errors'):
+                self._initNode(integrate_node)
+            for entry in integrate_node.sugs:
+                for conflict, suggestion in entry.items():
+                    if suggestion is None:
+                        entry[conflict] = ('Analysis of this conflict did'
+                                           ' not run, see the ' + key + '.')
+            integrate_node.skipped = None
+            integrate_node.errors.append({key: str(error)})
+            integrate_node.sugs.append({key: sug})
+
+    def _testNode(self, integrate_node):
+        """
+            tests the change of a single node, counting it against the run
+            budget when it failed
+
+            @param integrate_node: the change node
+        """
+        integrate = integrate_node.req_change
+        if (self._skipped(integrate, [integrate_node]) or
+                str(integrate) in self.clean):
+            return
+        if int(integrate) == 0:
+            self._noChange(integrate_node)
+        else:
+            self._timedIntegrate(None, integrate, integrate_node)
+            self.metrics.maybeWrite()
+        if self._failed(integrate_node):
+            self.budget.failed()
+
+    def releaseRequest(self, request):
+        """
+            drops the P4 payloads of a reported request
+
+            @param request: the request node
+        """
+        for integrate_node in request.children:
+            self._planned.pop(str(integrate_node.req_change), None)
+            for attr in ('change_desc', 'res_result'):
+                if hasattr(integrate_node, attr):
+                    delattr(integrate_node, attr)
+
+    def collectResults(self):
         """
             walks done integrations formating result data for report
         """
+        return list(self.iterResults())
 
-        # console report and details for jinja template gathering
-        requests = []
+    def iterResults(self):
+        """
+            yields the result data of the requests one at a time
+        """
         for request in self.pt_data.children:
-            req = dict(req_id=request.req_id, changes=[])
-            for integrate in request.children:
-                if not integrate.errors and not integrate.warnings:
-                    chg = dict(orig_change=integrate.req_change,
-                               result='SUCCESS',
-                               sugs=None,
-                               details='This change was successfully'
-                                       ' integrated')
-                    req['changes'].append(chg)
-                    continue
+            yield self.requestResult(request)
 
-                if integrate.errors:
-                    errors = ''
-                    sugs = ''
-
-                    for error, sug in zip(integrate.errors, integrate.sugs):
-                        for key, value in list(error.items()):
-                            errors += str(key) + ": " + str(value) + "\n"
-                        for key, value in list(sug.items()):
-                            sugs += str(key) + ": " + str(value) + "\n"
-                    if integrate.crosscomponent:
-                        chg = dict(orig_change=integrate.req_change,
-                                   result='WARNING',
-                                   sugs=sugs.replace("\n", "<br/>"),
-                                   details=errors.replace("\n", "<br/>"))
-                    else:
-                        chg = dict(orig_change=integrate.req_change,
-                                   result='FAILED',
-                                   sugs=sugs.replace("\n", "<br/>"),
-                                   details=errors.replace("\n", "<br/>"))
+    def requestResult(self, request):
+        """
+            formats the result data of a request for the report
 
-                    req['changes'].append(chg)
-                    continue
+            @param request: the request node
+        """
+        req = dict(req_id=request.req_id,
+                   owner=getattr(request, 'owner', None),
+                   changes=[self.changeResult(integrate)
+                            for integrate in request.children])
+        return req
+
+    @staticmethod
+    def _joinEntries(entries, sugs):
+        """
+            returns the html of result entries and their suggestions
+
+            @param entries: list of {key: description} errors or warnings
+            @param sugs: list of {key: suggestion}
+        """
+        details = []
+        suggestions = []
+        for entry, sug in zip(entries, sugs):
+            for key, value in entry.items():
+                details.append(str(key) + ": " + str(value))
+            for key, value in sug.items():
+                suggestions.append(str(key) + ": " + str(value))
+        return ("<br/>".join(details).replace("\n", "<br/>"),
+                "<br/>".join(suggestions).replace("\n", "<br/>"))
+
+    def changeResult(self, integrate):
+        """
+            formats the result data of a requested change for the report
+
+            @param integrate: the change node
+        """
+        if getattr(integrate, 'duplicate', False):
+            return self._outcome(integrate)
+
+        from_prefix = self.pt_data.p4_from_prefix
+        to_prefix = self.pt_data.branches[0]['p4_to_prefix']
+        errors = getattr(integrate, 'errors', [])
+        warnings = getattr(integrate, 'warnings', [])
+
+        if getattr(integrate, 'skipped', None):
+            chg = dict(orig_change=integrate.req_change,
+                       result='SKIPPED',
+                       sugs=None,
+                       details='This change was not tested, ' +
+                               integrate.skipped)
+        elif not errors and not warnings:
+            details = 'This change was successfully integrated'
+            if getattr(integrate, 'prescreen', None) == PRESCREEN_CLEAN:
+                details = ('This change was not integrated, the'
+                           ' pre-screen found it trivially clean: ' +
+                           integrate.prescreen_reason)
+            chg = dict(orig_change=integrate.req_change,
+                       result='SUCCESS',
+                       sugs=None,
+                       details=details)
+        elif errors:
+            details, sugs = self._joinEntries(errors, integrate.sugs)
+            if integrate.crosscomponent:
+                chg = dict(orig_change=integrate.req_change,
+                           result='WARNING',
+                           sugs=sugs,
+                           details=details)
+            else:
+                chg = dict(orig_change=integrate.req_change,
+                           result='FAILED',
+                           sugs=sugs,
+                           details=details)
+        else:
+            details, sugs = self._joinEntries(warnings, integrate.sugs)
+            chg = dict(orig_change=integrate.req_change,
+                       result='FAILED',
+                       sugs=sugs,
+                       details=details)
+
+        chg['prescreen'] = getattr(integrate, 'prescreen', None)
+        chg['error_keys'] = [key for entry in errors + warnings
+                             for key in entry]
+        change_desc = getattr(integrate, 'change_desc', {})
+        chg['files'] = [file.replace(from_prefix, to_prefix, 1)
+                        for file in change_desc.get('depotFile', [])]
+        chg['conflict_files'] = getattr(integrate, 'conflict_files', [])
+        chg['seconds'] = getattr(integrate, 'elapsed', None)
+        chg['components'] = [[component, self.components.owner(component)]
+                             for component in
+                             getattr(integrate, 'components', [])]
+        if self.streaming and getattr(integrate, 'duplicate', None) is False:
+            # kept for requests of the same change
+            change = str(integrate.req_change)
+            self.tested[change] = (integrate.parent.req_id, chg['result'])
+            self.outcomes[change] = dict(chg)
+            if len(self.outcomes) > OUTCOME_CACHE:
+                self.outcomes.popitem(last=False)
+        return chg
+
+    def _outcome(self, integrate):
+        """
+            returns a copy of the reported result of a streamed change for
+            another request of it
+
+            @param integrate: the duplicate change node
+        """
+        change = str(integrate.req_change)
+        if change in self.outcomes:
+            self.outcomes.move_to_end(change)
+            return dict(self.outcomes[change])
+        req_id, result = self.tested[change]
+        return dict(orig_change=integrate.req_change,
+                    result=result,
+                    sugs=None,
+                    details='This change was tested for request {0}, see'
+                            ' its result there'.format(req_id),
+                    prescreen=None,
+                    error_keys=[],
+                    files=[],
+                    conflict_files=[],
+                    seconds=None,
+                    components=[])
+
+    def generateReport(self, requests=None):
+        """
+            renders the collected results of the target branch as html
+
+            @param requests: results from collectResults, collected if None
+        """
+        if requests is None:
+            requests = self.iterResults()
+
+        return render_report(requests, self.pt_data.p4_from_prefix,
+                             self.pt_data.branches[0]['p4_to_prefix'])
 
-                if integrate.warnings:
-                    warnings = ''
-                    sugs = ''
-
-                    for warn, sug in zip(integrate.warnings, integrate.sugs):
-                        for key, value in list(warn.items()):
-                            warnings += str(key) + ": " + str(value) + "\n"
-                        for key, value in list(sug.items()):
-                            sugs += str(key) + ": " + str(value) + "\n" 
-
-                    chg = dict(orig_change=integrate.req_change,
-                               result='FAILED',
-                               sugs=sugs.replace("\n", "<br/>"),
-                               details=warnings.replace("\n", "<br/>"))
-                    req['changes'].append(chg)
-                    continue
-            requests.append(req)
-
-        # jinja html template
-        script_dir = os.path.join(os.path.dirname(__file__), 'data')
-        env = Environment(loader=FileSystemLoader(searchpath=script_dir))
-        template = env.get_template('email_notify.tmpl')
-
-        subject = ("<b>from " + self.pt_data.p4_from_prefix + " to " +
-                   self.pt_data.branches[0]['p4_to_prefix'] + "</b>")
-        report = template.render(title='patchTester Report',
-                                 subject=subject,
-                                 results=requests)
-        return report
-        
     def cleanup(self, dirty=True):
         """
             cleans up client from made integrations unless dirty specified
@@ -633,7 +1826,7 @@ class PatchTester(object):
                 sys.exit(1)
             else:
                 try:
-                    result = self.p4.run("revert", "//...")
+                    result = self._run("revert", "//...")
                     _logger.debug(str(result))
                 except P4.P4Exception as e:
                     if 'file(s) not opened' in str(e):
@@ -641,8 +1834,15 @@ class PatchTester(object):
                     else:
                         _logger.error('Error ' + str(e))
                         sys.exit(1)
+                except CommandTimeout as e:
+                    _logger.error('Error ' + str(e))
+                    sys.exit(1)
 
                 _logger.info('Deleting changes')
                 for change in self.pt_data.created_changelists:
-                    delete_result = self.p4.run('change', '-d', change)
-                    _logger.debug(delete_result)
+                    try:
+                        delete_result = self._run('change', '-d', change)
+                        _logger.debug(delete_result)
+                    except (P4.P4Exception, CommandTimeout) as e:
+                        _logger.error('Could not delete change {}: {}'
+                                      .format(change, e))
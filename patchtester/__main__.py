@@ -4,51 +4,248 @@ patchTester will evaluate pending patch requests for a branch.
 '''
 
 import argparse
-from anytree import Node, search
-from buildInfo.releaseInfo import ReleaseInfoCollection
 from collections import defaultdict
-from email.mime.text import MIMEText
-from jirautils import patch_request
 import getpass
 import logging
 import os
-import P4
-import smtplib
+import shutil
 import sys
-import yaml
-from yaml.representer import Representer
-yaml.add_representer(defaultdict, Representer.represent_dict)
 
 import patchtester
+from patchtester.components import ComponentMap
+from patchtester.lazy import LazyModule
+from patchtester.metrics import RunMetrics
+from patchtester.p4policy import CommandPolicy, parse_timeouts
+from patchtester.scheduler import RunBudget
+from patchtester.shards import (ResultsWriter, merge_results, parse_shard,
+                                 shard_requests, shard_tree, write_results)
+
+# loaded on first use, "--help" and argument errors do not pay for them
+P4 = LazyModule('P4')
 _logger = logging.getLogger(os.path.basename(sys.argv[0]))
 
-def send_report(payload, subject):
+def add_report_arguments(parser):
+    '''
+        adds the report delivery options to a parser
+
+        @param parser: the argparse parser
+    '''
+    parser.add_argument('--no_email',
+                        action='store_true',
+                        help='do not email the report',
+                        required=False)
+    parser.add_argument('--no_owner_reports',
+                        action='store_true',
+                        help='only email the full report to the invoking user',
+                        required=False)
+    parser.add_argument('--smtp_host',
+                        help='the SMTP server',
+                        default='localhost',
+                        required=False)
+    parser.add_argument('--smtp_port',
+                        help='the SMTP server port',
+                        type=int,
+                        default=25,
+                        required=False)
+    parser.add_argument('--report_dir',
+                        help='directory the reports are spooled to',
+                        required=False)
+    parser.add_argument('--section_limit',
+                        help='characters of a report section before it is cut'
+                             ' short and attached gzipped',
+                        type=int,
+                        default=100000,
+                        required=False)
+
+
+def send_report(branch_results, from_prefix, args,
+                subject='patchTester Report', diffs=None):
+    '''
+        email the full report to the logged in user and the rows of their
+        requests to every PRQ owner
+
+        @param branch_results: list of (branch, collected results)
+        @param from_prefix: the branch the changes are integrated from
+        @param args: the parsed report delivery options
+        @param subject: The subject string
+        @param diffs: the DiffCache of failed changes, None without diffs
+    '''
+    from patchtester.mailer import ReportSpool, address_of
+
+    user_address = address_of(getpass.getuser())
+    spool = ReportSpool(args.report_dir, args.section_limit, diffs)
+    for branch, results in branch_results:
+        spool.add(user_address, results, from_prefix, branch['p4_to_prefix'])
+        if args.no_owner_reports:
+            continue
+        owners = defaultdict(list)
+        for req in results:
+            if req.get('owner'):
+                owners[address_of(req['owner'])].append(req)
+        # the full report already holds the user's own requests
+        owners.pop(user_address, None)
+        for address, requests in owners.items():
+            spool.add(address, requests, from_prefix, branch['p4_to_prefix'])
+
+    return deliver_reports(spool, args, subject)
+
+
+def deliver_reports(spool, args, subject='patchTester Report'):
     '''
-        email report to logged in user
+        emails the spooled reports returning the path of the full report
 
-        @param payload: The html payload string
+        @param spool: the ReportSpool of the run
+        @param args: the parsed report delivery options
         @param subject: The subject string
     '''
-    _logger.info("\nSending Email Report")
-    from_address = "{0}@example.com".format(getpass.getuser())
+    from patchtester.mailer import address_of, send_reports
+
+    user_address = address_of(getpass.getuser())
+    if not args.no_email:
+        _logger.info("\nSending Email Report")
+        send_reports(spool, subject, args.smtp_host, args.smtp_port,
+                     user_address)
+    _logger.info("Reports spooled to " + spool.directory)
+    return spool.path(user_address)
+
+
+def merge_main(argv=None):
+    '''
+        merges the result files of a sharded run into one report,
+        "patchtester merge ..."
 
-    msg = MIMEText(payload, 'html')
-    msg["Subject"] = subject
-    msg["From"] = from_address
-    msg["To"] = from_address
+        @param argv: the arguments following "merge"
+    '''
+    parser = argparse.ArgumentParser(prog='patchtester merge',
+                                     description='merge shard results into '
+                                                 'one patchTester report')
+    parser.add_argument('results',
+                        nargs='+',
+                        help='the results files written with --results')
+    parser.add_argument('-o', '--output',
+                        help='write the html report to this file',
+                        required=False)
+    add_report_arguments(parser)
+    args = parser.parse_args(argv)
 
-    # You'll need to configure your own SMTP server here
-    # This is a placeholder
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
     try:
-        server = smtplib.SMTP("localhost")
-        server.sendmail(from_address, from_address, msg.as_string())
-        server.quit()
-    except:
-        _logger.warning("Could not send email. SMTP server may not be configured.")
-        _logger.warning("Report output:\n" + payload)
+        from_prefix, branches = merge_results(args.results)
+    except ValueError as e:
+        _logger.error('Error ' + str(e))
+        sys.exit(1)
+    report_path = send_report(branches, from_prefix, args)
+    if args.output:
+        shutil.copyfile(report_path, args.output)
+
+
+def detect_branch_from(catalog, p4, changes, sample=10):
+    '''
+        returns the release most of the requested changes were submitted
+        to, or None
+
+        @param catalog: the ReleaseCatalog
+        @param p4: the connection
+        @param changes: the requested changes
+        @param sample: the number of changes looked at
+    '''
+    found = defaultdict(int)
+    releases = {}
+    for change in [change for change in changes if int(change) != 0][:sample]:
+        try:
+            release = catalog.GetReleaseByChange(p4, change)
+        except P4.P4Exception as e:
+            _logger.debug('could not describe ' + str(change) + ' ' + str(e))
+            continue
+        if release is not None:
+            found[release.stream_prefix] += 1
+            releases[release.stream_prefix] = release
+    if not found:
+        return None
+    return releases[max(found, key=found.get)]
+
+
+def fetch_requests(args, target_name):
+    '''
+        yields (request id, owner, changes) of the requests to test as they
+        are fetched
+
+        @param args: the parsed options
+        @param target_name: the release the requests are made for
+    '''
+    from jirautils import patch_request
+
+    def requested():
+        for request in args.requests:
+            try:
+                yield patch_request.getVersionPatch(request)
+            except patch_request.PatchRequestError as e:
+                _logger.error('\n\nError with '+ request + ' skipping it')
+
+    if args.integrations: # case 1: passed in list of changes
+        # since no PRQ id; we label this as a "local"
+        yield 'local', None, list(args.integrations)
+        return
+
+    if args.requests: # case 2: passed in list of PRQS
+        dep_data = requested()
+    elif args.pending: # case 3: pending PRQs
+        dep_data = patch_request.getPendingVersionPatches(target_name)
+    else: # case 4: normal run. requested PRQS that have been accepted
+        dep_data = patch_request.getAcceptedVersionPatches(target_name)
+
+    for request in dep_data:
+        # a request without changes depends on a patch in the
+        # originating branch that has not been done yet.
+        yield (str(request.id), getattr(request, 'owner', None),
+               list(request.changes) or [0])
+
+
+def stream_run(pt, requests, args, history=None, run_id=None):
+    '''
+        tests the requests of the target branch with the streaming
+        pipeline, returning the report spool
+
+        @param pt: the PatchTester
+        @param requests: the requests from fetch_requests
+        @param args: the parsed options
+        @param history: the ResultsHistory of the run
+        @param run_id: the history run
+    '''
+    from patchtester.mailer import ReportSpool, address_of
+    from patchtester.pipeline import Pipeline
+
+    branch = pt.pt_data.branches[0]
+    if args.shard:
+        requests = shard_requests(requests, *args.shard)
+    spool = ReportSpool(args.report_dir, args.section_limit, pt.diffs)
+    results = None
+    if args.results:
+        results = ResultsWriter(args.results, pt.pt_data.p4_from_prefix,
+                                args.shard)
+    pipeline = Pipeline(pt, prescreen=args.prescreen)
+    try:
+        with pt.metrics.phase('sync', branch['name']):
+            pt.prepForIntegration()
+        with pt.metrics.phase('stream', branch['name']):
+            pipeline.run(requests, spool, address_of(getpass.getuser()),
+                         not args.no_owner_reports, history, run_id, results)
+    finally:
+        if results:
+            results.close()
+    if not pipeline.requests:
+        _logger.info('No patch requests found for branch {}'.format(
+                     branch['name']))
+    return spool
 
 
 def main():
+    if sys.argv[1:2] == ['history']:
+        from patchtester.history import history_main
+        return history_main(sys.argv[2:])
+    if sys.argv[1:2] == ['merge']:
+        return merge_main(sys.argv[2:])
+
     parser = argparse.ArgumentParser(description=__doc__)
 
     parser.add_argument('-t', '--branch_to',
@@ -56,11 +253,23 @@ def main():
                         type=lambda x: x.split(','),
                         required=True)
     parser.add_argument('-f', '--branch_from',
-                        help='the branch from',
-                        required=True)
+                        help='the branch from, detected from the requested'
+                             ' changes if not given',
+                        required=False)
     parser.add_argument('-c', '--client',
                         help='the perforce client to use',
                         required=True)
+    parser.add_argument('--catalog',
+                        help='YAML/JSON release catalog file',
+                        required=False)
+    parser.add_argument('--catalog_max_age',
+                        help='seconds the cached release catalog is reused',
+                        type=int,
+                        default=60 * 60,
+                        required=False)
+    parser.add_argument('--components',
+                        help='YAML component map for cross component checks',
+                        required=False)
     parser.add_argument('-p', '--pending',
                         action="store_true",
                         help='test pending not yet accepted PRQS',
@@ -77,11 +286,96 @@ def main():
                         action='store_true',
                         help='do not cleanup client',
                         required=False)
+    parser.add_argument('-b', '--batch',
+                        action='store_true',
+                        help='integrate non overlapping changes together',
+                        required=False)
+    parser.add_argument('-s', '--prescreen',
+                        action='store_true',
+                        help='skip changes that metadata shows are clean',
+                        required=False)
+    parser.add_argument('-w', '--workers',
+                        help='connections used to analyze conflicts',
+                        type=int,
+                        default=4,
+                        required=False)
+    parser.add_argument('--diffs',
+                        action='store_true',
+                        help='include diffs of failed changes in the report',
+                        required=False)
+    parser.add_argument('--diff_cache_mb',
+                        help='memory cap for loaded diffs in megabytes',
+                        type=int,
+                        default=16,
+                        required=False)
+    parser.add_argument('--timeout',
+                        help='seconds a p4 command may run by default',
+                        type=float,
+                        default=600,
+                        required=False)
+    parser.add_argument('--command_timeouts',
+                        help='per command timeouts e.g. integ=1800,filelog=300',
+                        type=parse_timeouts,
+                        required=False)
+    parser.add_argument('--retries',
+                        help='retries of p4 commands failing with transient'
+                             ' errors',
+                        type=int,
+                        default=2,
+                        required=False)
+    parser.add_argument('--history',
+                        help='sqlite database the results are recorded in',
+                        required=False)
+    parser.add_argument('--max_failures',
+                        help='stop testing after this many failed changes,'
+                             ' riskiest changes are tested first',
+                        type=int,
+                        required=False)
+    parser.add_argument('--time_budget',
+                        help='seconds after which testing stops and the'
+                             ' partial report is sent, riskiest changes are'
+                             ' tested first',
+                        type=float,
+                        required=False)
+    parser.add_argument('--metrics',
+                        help='prometheus textfile the run metrics are written to',
+                        required=False)
+    parser.add_argument('--metrics_interval',
+                        help='seconds between metrics writes during a run',
+                        type=int,
+                        default=60,
+                        required=False)
+    parser.add_argument('--shard',
+                        help='only test shard i of N of the requests, e.g. 1/4',
+                        type=parse_shard,
+                        required=False)
+    parser.add_argument('--results',
+                        help='write the collected results to this file for'
+                             ' patchtester merge',
+                        required=False)
+    add_report_arguments(parser)
+    parser.add_argument('--stream',
+                        action='store_true',
+                        help='test and report the requests as they are'
+                             ' fetched, with flat memory use',
+                        required=False)
+    parser.add_argument('-n', '--dry_run',
+                        action='store_true',
+                        help='list the requests and changes to test and exit',
+                        required=False)
     parser.add_argument('-v', '--verbose',
                         action='store_true',
                         help='debug logging',
                         required=False)
     args = parser.parse_args()
+    if args.stream:
+        if len(args.branch_to) > 1:
+            parser.error('--stream tests a single target branch')
+        if not args.branch_from:
+            parser.error('--stream needs the branch from, -f')
+        if args.batch:
+            parser.error('--stream integrates changes one at a time, -b'
+                         ' does not apply')
 
     if args.verbose:
         log_format = "[%(levelname)s - %(lineno)s - %(funcName)s ] %(message)s"
@@ -100,17 +394,28 @@ def main():
         _logger.setLevel(logging.INFO)
         DEBUG = 0
 
+    from anytree import Node
+    from patchtester.catalog import ReleaseCatalog
 
     # Tree data structure; root is base.
     _logger.debug('Building root node')
     ptData = Node('root', parent=None)
+    ptData.metrics = metrics = RunMetrics(args.metrics, args.metrics_interval)
+    ptData.budget = budget = RunBudget(args.max_failures, args.time_budget)
 
     # get the desired target branches
     ptData.branches = []
     target_name = None
     short_name = None
+    try:
+        catalog = ReleaseCatalog.load(args.catalog,
+                                      max_age=args.catalog_max_age)
+    except (OSError, ValueError) as e:
+        _logger.error('Error loading the release catalog: ' + str(e))
+        sys.exit(1)
+    ptData.catalog = catalog
     for branch in args.branch_to:
-        branch_info = ReleaseInfoCollection().GetReleaseByName(branch)
+        branch_info = catalog.GetReleaseByName(branch)
         if branch_info is None:
             _logger.info('branch ' + str(branch) + ' not found.')
             sys.exit(1)
@@ -122,10 +427,9 @@ def main():
         branch_obj['p4_to_prefix'] = branch_info.stream_prefix
         ptData.branches.append(branch_obj)
 
-        from_branch = ReleaseInfoCollection().GetReleaseByName(args.branch_from)
-        if ( args.branch_from == 'dev'):
-            from_branch.stream_prefix = "//depot/streams/dev"
-        elif from_branch is None:
+    if args.branch_from:
+        from_branch = catalog.GetReleaseByName(args.branch_from)
+        if from_branch is None:
             _logger.info('branch ' + str(args.branch_from) + ' not found.')
             sys.exit(1)
 
@@ -134,6 +438,48 @@ def main():
     # list of all changelists created for clean up at end
     ptData.created_changelists = []
 
+    # get the requested integrations
+    ptData.requested_integrates = []
+    streaming = args.stream and not args.dry_run
+    requests = fetch_requests(args, target_name)
+    if not streaming:
+        request_nodes = {}
+        for req_id, owner, changes in requests:
+            if req_id not in request_nodes:
+                # The requests go on the 2nd level of tree
+                request_nodes[req_id] = Node(req_id, req_id=req_id,
+                                             owner=owner, parent=ptData)
+            for change in changes:
+                # Requested integrates go on 3rd level
+                Node(change, req_change=change, parent=request_nodes[req_id])
+                ptData.requested_integrates.append(change)
+
+        if not ptData.children:
+            _logger.info('No patch requests found for branch {}'.format(
+                          short_name))
+            sys.exit(1)
+
+    if args.shard and not streaming:
+        ptData.requested_integrates = shard_tree(ptData, *args.shard)
+        _logger.info('Shard {0}/{1}: {2} requests, {3} changes'.format(
+                     args.shard[0], args.shard[1], len(ptData.children),
+                     len(ptData.requested_integrates)))
+
+    # a change requested by several PRQs is only integrated once per
+    # branch, its result is fanned out to every requesting node.
+    ptData.requested_integrates = list(set(str(change) for change in
+                                           ptData.requested_integrates))
+    # in order from lowest to highest
+    ptData.requested_integrates.sort(key=int)
+
+    if args.dry_run:
+        for request in ptData.children:
+            _logger.info('{0}: {1}'.format(request.req_id, ', '.join(
+                str(integrate.req_change) for integrate in request.children)))
+        _logger.info('{0} requests, {1} changes to test'.format(
+                     len(ptData.children), len(ptData.requested_integrates)))
+        return
+
     # the client to use
     valid = False
     if args.client:  
@@ -159,77 +505,89 @@ def main():
 
     ptData.p4 = p4
     ptData.p4_client = args.client
-
-    # get the requested integrations
-    ptData.requested_integrates = []
-    dep_data = []
-    fixup_req = False
-    if args.integrations: # case 1: passed in list of changes
-        # since no PRQ id; we label this as a "local"
-        local = Node('local', req_id='local', parent=ptData)
-        for change in args.integrations:  
-            ptData.requested_integrates.append(change)
-            Node(change, req_change=change, parent=local)
-
-    elif args.requests: # case 2: passed in list of PRQS
-        for request in args.requests:
-            try:
-                result = patch_request.getVersionPatch(request)
-            except patch_request.PatchRequestError as e:
-                _logger.error('\n\nError with '+ request + ' skipping it') 
-                continue
-            dep_data.append(result)
-        fixup_req = True
-    elif args.pending: # case 3: pending PRQs
-        dep_data = patch_request.getPendingVersionPatches(target_name)
-        fixup_req = True
-    else: # case 4: normal run. requested PRQS that have been accepted
-        dep_data = patch_request.getAcceptedVersionPatches(target_name)
-        fixup_req = True
-
-    if not dep_data and fixup_req:
-        _logger.info('No patch requests found for branch {}'.format(
-                      short_name))
+    ptData.workers = args.workers
+    try:
+        ptData.components = ComponentMap.load(args.components)
+    except (OSError, ValueError) as e:
+        _logger.error('Error loading the components: ' + str(e))
         sys.exit(1)
+    ptData.policy = CommandPolicy(args.timeout, args.command_timeouts,
+                                  args.retries, deadline=budget.deadline)
+    ptData.report_diffs = args.diffs
+    ptData.diff_cache_bytes = args.diff_cache_mb * 1024 * 1024
 
-    if fixup_req:
-        requests = defaultdict(list)
-        for request in dep_data:
-            if request.changes: # only add those that have existing changes
-                for change in request.changes:
-                    requests[str(request.id)].append(change)
-                    ptData.requested_integrates.append(change)
-            else:
-                # request has no changes, it depends on patch
-                # in originating branch that has not been done yet.
-                requests[str(request.id)].append(0)
-                ptData.requested_integrates.append('0')
-
-        #  add all requests and changes (uniques) to the tree
-        for req in requests:
-            # The requests go on the 2nd level of tree
-            new_node = Node(req, req_id=req, parent=ptData)
-            for change in requests[str(req)]:
-                # Requested integrates go on 3rd level
-                Node(change, req_change=change, parent=new_node)
+    if not args.branch_from:
+        from_branch = detect_branch_from(catalog, p4,
+                                         ptData.requested_integrates)
+        if from_branch is None:
+            _logger.info('could not detect the branch from, use -f')
+            sys.exit(1)
+        _logger.info('Detected branch from ' + from_branch.stream_prefix)
+        ptData.p4_from_prefix = from_branch.stream_prefix
 
-    ptData.requested_integrates.sort() # in order from lowest to highest
+    history = None
+    run_id = None
+    if args.history:
+        from patchtester.history import ResultsHistory
+        history = ResultsHistory(args.history)
+        run_id = history.startRun(ptData.p4_from_prefix)
+    ptData.history = history
 
     # now with data init the class
     pt = patchtester.PatchTester(ptData, DEBUG)
 
-    report = ""
-    for branch in pt.pt_data.branches:
-        pt.prepForIntegration()
-        pt.doIntegrations()   
-        report += pt.generateReport()
-        pt.pt_data.branches = pt.pt_data.branches[1:]
-        #break if no new branches 
-        if pt.pt_data.branches == []:
-            break
+    if streaming:
+        spool = stream_run(pt, requests, args, history, run_id)
+    else:
+        with metrics.phase('plan'):
+            pt.planChanges()
+
+        branch_results = []
+        for branch in pt.pt_data.branches:
+            name = pt.pt_data.branches[0]['name']
+            with metrics.phase('sync', name):
+                pt.prepForIntegration()
+            if args.prescreen:
+                with metrics.phase('prescreen', name):
+                    pt.preScreen()
+            with metrics.phase('integrate', name):
+                if args.batch:
+                    pt.doBatchIntegrations()
+                else:
+                    pt.doIntegrations()
+            with metrics.phase('suggest', name):
+                pt.analyzeConflicts()
+            with metrics.phase('report', name):
+                results = pt.collectResults()
+                metrics.recordResults(name, results)
+                if history:
+                    history.record(run_id, name, results)
+                branch_results.append((pt.pt_data.branches[0], results))
+            metrics.write()
+            pt.pt_data.branches = pt.pt_data.branches[1:]
+            #break if no new branches 
+            if pt.pt_data.branches == []:
+                break
+
+    if budget.stopped:
+        _logger.info('Testing stopped early, ' + budget.stopped)
+
+    if history:
+        _logger.info('Results recorded as run {}'.format(run_id))
+        history.close()
+
+    if args.results and not streaming:
+        write_results(args.results, ptData.p4_from_prefix, branch_results,
+                      args.shard)
 
     pt.cleanup(args.dirty)
-    send_report(report, 'patchTester Report')
+    with metrics.phase('email'):
+        if streaming:
+            deliver_reports(spool, args)
+        else:
+            send_report(branch_results, ptData.p4_from_prefix, args,
+                        diffs=pt.diffs)
+    metrics.write()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,144 @@
+'''
+Release catalog loaded once per run, indexed by name and by stream prefix.
+'''
+import json
+import logging
+import os
+import sys
+import time
+
+from buildInfo.releaseInfo import ReleaseInfo, ReleaseInfoCollection
+
+_logger = logging.getLogger(os.path.basename(sys.argv[0]))
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'patchtester',
+                             'releases.json')
+
+
+class ReleaseCatalog(object):
+    """
+    Releases by name, and a trie of depot path components resolving any
+    depot path to the release whose stream prefix it is under.
+    """
+    def __init__(self, releases):
+        self._by_name = dict(releases)
+        self._trie = {}
+        for info in self._by_name.values():
+            node = self._trie
+            for part in self._parts(info.stream_prefix):
+                node = node.setdefault(part, {})
+            node[None] = info
+
+    @staticmethod
+    def _parts(path):
+        return [part for part in path.split('/') if part]
+
+    @classmethod
+    def load(cls, path=None, cache_path=DEFAULT_CACHE, max_age=60 * 60):
+        """
+            loads the catalog from a YAML/JSON file or, without one, from
+            the release information service.  The result is cached as
+            JSON and reused while it is younger than max_age and than the
+            catalog file.  Raises OSError when the catalog file can not be
+            read and ValueError when it is not a valid catalog.
+
+            @param path: the catalog file
+            @param cache_path: the cache file, None disables caching
+            @param max_age: seconds a cached catalog stays fresh
+        """
+        releases = cls._readCache(path, cache_path, max_age)
+        if releases is None:
+            if path:
+                import yaml  # JSON is valid YAML
+                with open(path) as catalog_file:
+                    try:
+                        data = yaml.safe_load(catalog_file) or {}
+                    except yaml.YAMLError as e:
+                        raise ValueError('invalid release catalog {0}: {1}'
+                                         .format(path, e))
+                if not isinstance(data, dict):
+                    raise ValueError('invalid release catalog ' + path)
+                releases = data.get('releases', data)
+            else:
+                releases = {}
+                for name, info in ReleaseInfoCollection().GetReleases().items():
+                    releases[name] = dict(version=info.version,
+                                          release_name=info.release_name,
+                                          stream_prefix=info.stream_prefix)
+            cls._writeCache(cache_path, releases, path)
+
+        try:
+            return cls(dict((name,
+                             ReleaseInfo(info['version'], info['release_name'],
+                                         info['stream_prefix'].rstrip('/')))
+                            for name, info in releases.items()))
+        except (AttributeError, KeyError, TypeError) as e:
+            raise ValueError('invalid release catalog {0}: {1!r}'
+                             .format(path, e))
+
+    @staticmethod
+    def _readCache(path, cache_path, max_age):
+        if not cache_path or not os.path.exists(cache_path):
+            return None
+        cached = os.path.getmtime(cache_path)
+        if time.time() - cached > max_age:
+            return None
+        if path and os.path.getmtime(path) > cached:
+            return None
+        try:
+            with open(cache_path) as cache_file:
+                data = json.load(cache_file)
+        except ValueError:
+            return None
+        if data.get('source') != (path and os.path.abspath(path)):
+            return None
+        _logger.debug('using cached release catalog ' + cache_path)
+        return data['releases']
+
+    @staticmethod
+    def _writeCache(cache_path, releases, path=None):
+        if not cache_path:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(cache_path)):
+                os.makedirs(os.path.dirname(cache_path))
+            tmp_path = cache_path + '.tmp'
+            with open(tmp_path, 'w') as cache_file:
+                json.dump(dict(source=path and os.path.abspath(path),
+                               releases=releases), cache_file)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            _logger.debug('could not cache release catalog ' + str(e))
+
+    def GetReleaseByName(self, name):
+        """
+            returns the release of a name or None
+        """
+        return self._by_name.get(name)
+
+    def GetReleaseByPath(self, depot_path):
+        """
+            returns the release with the longest stream prefix containing
+            a depot path, or None
+
+            @param depot_path: e.g. //depot/streams/dev/lib/file.cpp
+        """
+        node = self._trie
+        found = node.get(None)
+        for part in self._parts(depot_path):
+            node = node.get(part)
+            if node is None:
+                break
+            found = node.get(None, found)
+        return found
+
+    def GetReleaseByChange(self, p4, change):
+        """
+            returns the release of the files of a submitted change, or None
+
+            @param p4: the connection
+            @param change: the changelist number
+        """
+        change_desc = p4.run('describe', '-s', int(change))[0]
+        files = change_desc.get('depotFile') or [change_desc.get('path', '')]
+        return self.GetReleaseByPath(files[0])
@@ -0,0 +1,100 @@
+'''
+Classification of depot files into components for cross component
+detection and component grouped reports.
+'''
+
+# top level directories that are not components of their own
+DEFAULT_SKIP = ('testSpecs', 'SCons', 'buildMap')
+
+
+class ComponentMap(object):
+    """
+    A prefix trie of branch relative paths to components.
+
+    Paths not covered by a configured component belong to the component
+    named after their top level directory.  Components whose name contains
+    one of the skip rules are ignored.
+    """
+    def __init__(self, components=None, skip=DEFAULT_SKIP):
+        self.skip = tuple(skip)
+        self.owners = {}
+        self._trie = {}
+        for name, component in (components or {}).items():
+            self.owners[name] = component.get('owner')
+            for path in component.get('paths', [name]):
+                node = self._trie
+                for part in path.strip('/').split('/'):
+                    node = node.setdefault(part, {})
+                node[None] = name
+        self._cache = {}
+
+    @classmethod
+    def load(cls, path=None):
+        """
+            loads the components from a YAML file of the form
+            {components: {name: {paths: [...], owner: user}}, skip: [...]}.
+            Raises OSError when the file can not be read and ValueError when
+            it is not a valid component file.
+
+            @param path: the component file, defaults are used if None
+        """
+        if not path:
+            return cls()
+        import yaml
+        with open(path) as components_file:
+            try:
+                data = yaml.safe_load(components_file) or {}
+            except yaml.YAMLError as e:
+                raise ValueError('invalid component file {0}: {1}'
+                                 .format(path, e))
+        try:
+            return cls(data.get('components'), data.get('skip', DEFAULT_SKIP))
+        except (AttributeError, TypeError) as e:
+            raise ValueError('invalid component file {0}: {1!r}'
+                             .format(path, e))
+
+    def classify(self, relative_path):
+        """
+            returns the component of a branch relative path or None when
+            it is skipped
+
+            @param relative_path: e.g. lib/foo/file.cpp
+        """
+        parts = relative_path.split('/')
+        node = self._trie
+        component = None
+        for part in parts[:-1]:
+            node = node.get(part)
+            if node is None:
+                break
+            component = node.get(None, component)
+        if component is None:
+            component = parts[0]
+        if component in self._cache:
+            return self._cache[component]
+        skipped = any(rule in component for rule in self.skip)
+        self._cache[component] = None if skipped else component
+        return self._cache[component]
+
+    def components(self, files, prefix):
+        """
+            returns the set of components of files under a branch prefix
+
+            @param files: depot files
+            @param prefix: the branch stream prefix
+        """
+        prefix = prefix.rstrip('/') + '/'
+        found = set()
+        for file in files:
+            if not file.startswith(prefix):
+                continue
+            component = self.classify(file[len(prefix):])
+            if component is not None:
+                found.add(component)
+        return found
+
+    def owner(self, component):
+        """
+            returns the owner of a component or None
+        """
+        return self.owners.get(component)
@@ -0,0 +1,56 @@
+'''
+Lazily loaded changelist diffs with a bounded memory footprint.
+'''
+from collections import OrderedDict
+import logging
+import os
+import sys
+
+from patchtester.lazy import LazyModule
+
+P4 = LazyModule('P4')
+
+_logger = logging.getLogger(os.path.basename(sys.argv[0]))
+
+
+class DiffCache(object):
+    """
+    Fetches unified diffs of changelists on first use and keeps the most
+    recently used ones up to a total size.
+    """
+    def __init__(self, p4, max_bytes=16 * 1024 * 1024):
+        self.p4 = p4
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._diffs = OrderedDict()
+
+    def get(self, change):
+        """
+            returns the diff of a changelist, fetching it if needed
+
+            @param change: the changelist number
+        """
+        change = str(change)
+        if change in self._diffs:
+            self._diffs.move_to_end(change)
+            return self._diffs[change]
+
+        try:
+            with self.p4.while_tagged(False):
+                result = self.p4.run('describe', '-du', change)
+            diff = "\n".join(str(line) for line in result)
+        except P4.P4Exception as e:
+            _logger.debug("diff error " + str(e))
+            diff = "Unable to fetch diff of change " + change + "\n" + str(e)
+
+        if len(diff) > self.max_bytes:
+            diff = (diff[:self.max_bytes] +
+                    "\n... diff truncated at {} bytes".format(self.max_bytes))
+
+        self._diffs[change] = diff
+        self.size += len(diff)
+        while self.size > self.max_bytes and len(self._diffs) > 1:
+            evicted, old = self._diffs.popitem(last=False)
+            self.size -= len(old)
+            _logger.debug("evicted diff of change " + evicted)
+        return diff
@@ -0,0 +1,235 @@
+'''
+Local SQLite history of patchTester results.
+
+Every run records one row per (run, target branch, request, change, file)
+so that conflict hotspots and new failures can be queried without digging
+through old report emails or re-running anything.
+'''
+import argparse
+import datetime
+import socket
+import sqlite3
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started TEXT NOT NULL,
+    host TEXT,
+    from_prefix TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    branch TEXT NOT NULL,
+    request TEXT NOT NULL,
+    change TEXT NOT NULL,
+    depot_file TEXT NOT NULL DEFAULT '',
+    verdict TEXT NOT NULL,
+    error_keys TEXT NOT NULL DEFAULT '',
+    seconds REAL
+);
+CREATE INDEX IF NOT EXISTS results_run ON results(run_id);
+CREATE INDEX IF NOT EXISTS results_change ON results(change);
+CREATE INDEX IF NOT EXISTS results_file ON results(depot_file);
+CREATE INDEX IF NOT EXISTS results_branch ON results(branch, verdict);
+'''
+
+# per file verdict of a file reported in a resolution conflict
+CONFLICT = 'CONFLICT'
+
+# verdict of a change a run stopped before testing, neither pass nor fail
+SKIPPED = 'SKIPPED'
+
+# verdict of a change with cross component errors only, not a failure either
+WARNING = 'WARNING'
+
+# sqlite limits the number of parameters of a query
+_CHUNK = 500
+
+
+class ResultsHistory(object):
+    """
+    Results of past runs stored in a SQLite database
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def startRun(self, from_prefix=None):
+        """
+            adds a run returning its id
+
+            @param from_prefix: the branch the changes are integrated from
+        """
+        with self.db:
+            cursor = self.db.execute(
+                'INSERT INTO runs (started, host, from_prefix) VALUES (?, ?, ?)',
+                (datetime.datetime.now().isoformat(timespec='seconds'),
+                 socket.gethostname(), from_prefix))
+        return cursor.lastrowid
+
+    def record(self, run_id, branch, requests):
+        """
+            stores the collected results of a target branch
+
+            @param run_id: the id returned by startRun
+            @param branch: the target branch name
+            @param requests: the data returned by PatchTester.collectResults
+        """
+        rows = []
+        for req in requests:
+            for chg in req['changes']:
+                error_keys = ','.join(chg.get('error_keys') or [])
+                files = chg.get('files') or ['']
+                conflicts = set(chg.get('conflict_files') or [])
+                for file in files:
+                    verdict = CONFLICT if file in conflicts else chg['result']
+                    rows.append((run_id, branch, str(req['req_id']),
+                                 str(chg['orig_change']), file, verdict,
+                                 error_keys, chg.get('seconds')))
+        with self.db:
+            self.db.executemany('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                rows)
+
+    def hotspots(self, branch=None, limit=20):
+        """
+            returns the files with the most conflicts as
+            (depot_file, branch, conflicts, runs) rows
+
+            @param branch: only count conflicts in this target branch
+            @param limit: the number of files returned
+        """
+        query = ('SELECT depot_file, branch, COUNT(*), COUNT(DISTINCT run_id)'
+                 ' FROM results WHERE verdict = ?')
+        params = [CONFLICT]
+        if branch:
+            query += ' AND branch = ?'
+            params.append(branch)
+        query += ' GROUP BY depot_file, branch ORDER BY 3 DESC, 1 LIMIT ?'
+        params.append(limit)
+        return self.db.execute(query, params).fetchall()
+
+    def failureRates(self, branch, files):
+        """
+            returns {depot_file: fraction of tested changes that failed}
+            of the files with results in a target branch
+
+            @param branch: the target branch name
+            @param files: the target depot files
+        """
+        files = list(files)
+        rates = {}
+        for start in range(0, len(files), _CHUNK):
+            chunk = files[start:start + _CHUNK]
+            query = ('SELECT depot_file, AVG(verdict != ?) FROM results'
+                     ' WHERE branch = ? AND verdict NOT IN (?, ?)'
+                     ' AND depot_file IN'
+                     ' ({}) GROUP BY depot_file'
+                     .format(', '.join('?' * len(chunk))))
+            rates.update(self.db.execute(
+                query, ['SUCCESS', branch, SKIPPED, WARNING] + chunk))
+        return rates
+
+    def lastFailed(self, branch, changes):
+        """
+            returns {change: whether it failed} of the latest run that
+            tested each change in a target branch
+
+            @param branch: the target branch name
+            @param changes: the requested changes
+        """
+        changes = [str(change) for change in changes]
+        latest = {}
+        for start in range(0, len(changes), _CHUNK):
+            chunk = changes[start:start + _CHUNK]
+            query = ('SELECT change, run_id, MAX(verdict != ?) FROM results'
+                     ' WHERE branch = ? AND verdict NOT IN (?, ?)'
+                     ' AND change IN ({})'
+                     ' GROUP BY change, run_id'
+                     .format(', '.join('?' * len(chunk))))
+            for change, run_id, failed in self.db.execute(
+                    query, ['SUCCESS', branch, SKIPPED, WARNING] + chunk):
+                if change not in latest or run_id > latest[change][0]:
+                    latest[change] = (run_id, bool(failed))
+        return {change: failed for change, (run_id, failed) in latest.items()}
+
+    def lastRun(self):
+        """
+            returns the id of the latest run or None
+        """
+        return self.db.execute('SELECT MAX(id) FROM runs').fetchone()[0]
+
+    def newFailures(self, since, run_id=None):
+        """
+            returns (branch, request, change, error_keys) of changes that
+            failed in a run but not in an earlier one
+
+            @param since: the id of the earlier run
+            @param run_id: the id of the later run, defaults to the latest
+        """
+        if run_id is None:
+            run_id = self.lastRun()
+        query = ('SELECT DISTINCT branch, request, change, error_keys'
+                 ' FROM results r WHERE run_id = ? AND verdict NOT IN (?, ?, ?)'
+                 ' AND NOT EXISTS (SELECT 1 FROM results o'
+                 ' WHERE o.run_id = ? AND o.branch = r.branch'
+                 ' AND o.change = r.change AND o.verdict NOT IN (?, ?, ?))'
+                 ' ORDER BY branch, request, change')
+        return self.db.execute(query, (run_id, 'SUCCESS', SKIPPED, WARNING,
+                                       since, 'SUCCESS', SKIPPED,
+                                       WARNING)).fetchall()
+
+
+def history_main(argv=None):
+    '''
+        queries the results history, "patchtester history ..."
+
+        @param argv: the arguments following "history"
+    '''
+    parser = argparse.ArgumentParser(prog='patchtester history',
+                                     description=__doc__)
+    parser.add_argument('database',
+                        help='the history database')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    hotspots = commands.add_parser('hotspots',
+                                   help='files with the most conflicts')
+    hotspots.add_argument('-t', '--branch',
+                          help='only this target branch',
+                          required=False)
+    hotspots.add_argument('-n', '--limit',
+                          help='the number of files to list',
+                          type=int,
+                          default=20)
+
+    failures = commands.add_parser('new-failures',
+                                   help='changes failing since a run')
+    failures.add_argument('since', type=int,
+                          help='the run to compare with')
+    failures.add_argument('--run', type=int,
+                          help='the run to check, defaults to the latest')
+
+    commands.add_parser('runs', help='list the recorded runs')
+    args = parser.parse_args(argv)
+
+    history = ResultsHistory(args.database)
+    try:
+        if args.command == 'hotspots':
+            for depot_file, branch, conflicts, runs in history.hotspots(
+                    args.branch, args.limit):
+                print('{0:6d} {1:6d}  {2:10s} {3}'.format(conflicts, runs,
+                                                         branch, depot_file))
+        elif args.command == 'new-failures':
+            for branch, request, change, error_keys in history.newFailures(
+                    args.since, args.run):
+                print('{0:10s} {1:12s} {2:10s} {3}'.format(branch, request,
+                                                         change, error_keys))
+        else:
+            for run in history.db.execute('SELECT id, started, host, from_prefix'
+                                          ' FROM runs ORDER BY id'):
+                print('{0:6d} {1} {2} {3}'.format(*run))
+    finally:
+        history.close()
@@ -8,9 +8,10 @@ class PatchRequest:
     """
     Represents a patch request from a ticket system.
     """
-    def __init__(self, id, changes=None):
+    def __init__(self, id, changes=None, owner=None):
         self.id = id
         self.changes = changes or []
+        self.owner = owner
 
 
 class PatchRequestError(Exception):
@@ -0,0 +1,19 @@
+'''
+Deferred imports of heavy dependencies.
+'''
+import importlib
+
+
+class LazyModule(object):
+    """
+    Stands in for a module that is only imported when one of its
+    attributes is first used, e.g. P4 = LazyModule('P4').
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
@@ -0,0 +1,186 @@
+'''
+Per recipient report spooling and delivery over one SMTP session.
+'''
+import gzip
+import logging
+import os
+import re
+import sys
+import tempfile
+
+import patchtester
+
+_logger = logging.getLogger(os.path.basename(sys.argv[0]))
+
+
+def address_of(user):
+    '''
+        returns the email address of a user name
+
+        @param user: the user name or an address
+    '''
+    if '@' in user:
+        return user
+    return "{0}@example.com".format(user)
+
+
+def _file_name(address):
+    return re.sub(r'[^\w.@-]', '_', address)
+
+
+class ReportSpool(object):
+    """
+    Html reports of every recipient spooled to disk.
+
+    Report sections longer than section_limit are cut short in the report;
+    their full text goes to a gzipped html file sent as an attachment.  With
+    a DiffCache the diffs of failed changes are fetched while their rows are
+    written, so the results never hold them.
+    """
+    def __init__(self, directory=None, section_limit=100000, diffs=None):
+        self.directory = directory or tempfile.mkdtemp(prefix='patchtester_')
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.section_limit = section_limit
+        self.diffs = diffs
+        self._recipients = []
+
+    def path(self, address):
+        """
+            returns the report file of a recipient
+        """
+        return os.path.join(self.directory, _file_name(address) + '.html')
+
+    def detailsPath(self, address):
+        """
+            returns the gzipped full sections file of a recipient
+        """
+        return os.path.join(self.directory,
+                            _file_name(address) + '-details.html.gz')
+
+    def add(self, address, requests, from_prefix, to_prefix):
+        """
+            appends the report of a target branch to a recipient's report
+
+            @param address: the recipient
+            @param requests: results from PatchTester.collectResults
+            @param from_prefix: the branch the changes are integrated from
+            @param to_prefix: the target branch
+        """
+        if address not in self._recipients:
+            self._recipients.append(address)
+            for path in (self.path(address), self.detailsPath(address)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        details = []  # the gzipped details file, opened when needed
+
+        def bounded():
+            for req in requests:
+                changes = []
+                for chg in req['changes']:
+                    chg = dict(chg)
+                    if (self.diffs and chg['result'] == 'FAILED' and
+                            int(chg['orig_change']) != 0):
+                        chg['diff'] = self.diffs.get(chg['orig_change'])
+                    for section in ('details', 'sugs', 'diff'):
+                        text = chg.get(section)
+                        if text and len(text) > self.section_limit:
+                            if not details:
+                                # gzip files may be appended to, each
+                                # branch adds a member
+                                details.append(gzip.open(
+                                    self.detailsPath(address), 'at'))
+                            details[0].write('<h2>{0} change {1} {2}</h2>\n{3}\n'
+                                             .format(req['req_id'],
+                                                     chg['orig_change'],
+                                                     section, text))
+                            chg[section] = self._truncate(text)
+                    changes.append(chg)
+                yield dict(req, changes=changes)
+
+        try:
+            with open(self.path(address), 'a') as report_file:
+                patchtester.write_report(report_file, bounded(), from_prefix,
+                                         to_prefix)
+        finally:
+            for details_file in details:
+                details_file.close()
+
+    def _truncate(self, text):
+        cut = text.rfind('<br/>', 0, self.section_limit)
+        if cut <= 0:
+            cut = self.section_limit
+        return (text[:cut] + '<br/><b>... truncated, the full text is in the'
+                ' attached details file</b>')
+
+    def reports(self):
+        """
+            yields (address, report path, details path or None)
+        """
+        for address in self._recipients:
+            details = self.detailsPath(address)
+            yield (address, self.path(address),
+                   details if os.path.exists(details) else None)
+
+
+def _not_sent(address, path, error):
+    _logger.warning("Could not send report to {0}, it is in {1}: {2}"
+                    .format(address, path, error))
+
+
+def send_reports(spool, subject, host='localhost', port=25, sender=None):
+    '''
+        mails every spooled report over a single SMTP session
+
+        @param spool: the ReportSpool
+        @param subject: The subject string
+        @param host: the SMTP server
+        @param port: the SMTP port
+        @param sender: the from address
+    '''
+    from email.mime.application import MIMEApplication
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    import smtplib
+
+    server = None
+    try:
+        for address, path, details in spool.reports():
+            msg = MIMEMultipart()
+            msg["Subject"] = subject
+            msg["From"] = sender
+            msg["To"] = address
+            with open(path) as report_file:
+                msg.attach(MIMEText(report_file.read(), 'html'))
+            if details:
+                with open(details, 'rb') as details_file:
+                    attachment = MIMEApplication(details_file.read(), 'gzip')
+                attachment.add_header('Content-Disposition', 'attachment',
+                                      filename=os.path.basename(details))
+                msg.attach(attachment)
+            for attempt in (1, 2):
+                if server is None:
+                    server = smtplib.SMTP(host, port)
+                try:
+                    server.sendmail(sender, [address], msg.as_string())
+                    _logger.info("Sent report to " + address)
+                    break
+                except smtplib.SMTPServerDisconnected as e:
+                    # the server dropped the session, send on a new one
+                    server.close()
+                    server = None
+                    if attempt == 2:
+                        _not_sent(address, path, e)
+                except smtplib.SMTPException as e:
+                    _not_sent(address, path, e)
+                    break
+            del msg
+        if server is not None:
+            server.quit()
+    except (smtplib.SMTPException, OSError) as e:
+        _logger.warning("Could not send email. SMTP server may not be"
+                        " configured. " + str(e))
+        _logger.warning("Reports are in " + spool.directory)
+        if server is not None:
+            server.close()
@@ -0,0 +1,156 @@
+'''
+Run and phase metrics written as a Prometheus/OpenMetrics textfile.
+
+The file is meant for the node exporter textfile collector; it is replaced
+atomically at the end of a run and periodically while a run is going.
+'''
+from collections import defaultdict
+from contextlib import contextmanager
+import logging
+import os
+import sys
+import threading
+import time
+
+_logger = logging.getLogger(os.path.basename(sys.argv[0]))
+
+# phase duration buckets in seconds
+BUCKETS = (0.5, 1, 5, 15, 60, 300, 900, 1800, 3600, 7200, float('inf'))
+
+
+def _labels(**labels):
+    return ','.join('{0}="{1}"'.format(key, str(value).replace('"', '\\"'))
+                    for key, value in sorted(labels.items()))
+
+
+class RunMetrics(object):
+    """
+    Phase durations, per branch counts and P4 command counts of a run
+    """
+    def __init__(self, path=None, interval=60):
+        self.path = path
+        self.interval = interval
+        self.started = time.time()
+        self._written = self.started
+        self._lock = threading.Lock()
+        self._phases = {}  # (phase, branch) -> [bucket counts, sum, count]
+        self._counts = defaultdict(float)  # (name, labels) -> value
+        self._commands = defaultdict(int)
+
+    @contextmanager
+    def phase(self, name, branch=''):
+        """
+            times the enclosed block as a phase of the run
+
+            @param name: the phase e.g. sync, integrate, resolve
+            @param branch: the target branch
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, branch, time.time() - started)
+
+    def observe(self, name, branch, seconds):
+        """
+            adds a phase duration to its histogram
+        """
+        with self._lock:
+            hist = self._phases.setdefault((name, branch),
+                                           [[0] * len(BUCKETS), 0.0, 0])
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    hist[0][i] += 1
+            hist[1] += seconds
+            hist[2] += 1
+
+    def count(self, name, value=1, **labels):
+        """
+            increments a counter
+
+            @param name: the counter name without prefix and _total suffix
+        """
+        with self._lock:
+            self._counts[(name, _labels(**labels))] += value
+
+    def countCommand(self, command):
+        """
+            counts a P4 command by name
+        """
+        with self._lock:
+            self._commands[command] += 1
+
+    def recordResults(self, branch, requests):
+        """
+            counts the collected results of a target branch
+
+            @param branch: the target branch name
+            @param requests: the data returned by PatchTester.collectResults
+        """
+        for req in requests:
+            for chg in req['changes']:
+                self.count('changelists', branch=branch, result=chg['result'])
+                self.count('files', len(chg.get('files') or []), branch=branch)
+                self.count('conflicts', len(chg.get('conflict_files') or []),
+                           branch=branch)
+                if chg['result'] == 'WARNING':
+                    self.count('warnings', branch=branch)
+
+    def render(self):
+        """
+            returns the metrics in the text exposition format
+        """
+        lines = []
+        with self._lock:
+            lines.append('# HELP patchtester_phase_seconds Duration of run phases.')
+            lines.append('# TYPE patchtester_phase_seconds histogram')
+            for (name, branch), (buckets, total, count) in sorted(self._phases.items()):
+                for bound, value in zip(BUCKETS, buckets):
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append('patchtester_phase_seconds_bucket{%s} %d' %
+                                 (_labels(phase=name, branch=branch, le=le), value))
+                labels = _labels(phase=name, branch=branch)
+                lines.append('patchtester_phase_seconds_sum{%s} %f' % (labels, total))
+                lines.append('patchtester_phase_seconds_count{%s} %d' % (labels, count))
+
+            names = sorted(set(name for name, labels in self._counts))
+            for name in names:
+                lines.append('# TYPE patchtester_%s_total counter' % name)
+                for (key, labels), value in sorted(self._counts.items()):
+                    if key == name:
+                        lines.append('patchtester_%s_total{%s} %d' %
+                                     (name, labels, value))
+
+            lines.append('# TYPE patchtester_p4_commands_total counter')
+            for command, value in sorted(self._commands.items()):
+                lines.append('patchtester_p4_commands_total{%s} %d' %
+                             (_labels(command=command), value))
+
+        lines.append('# TYPE patchtester_run_seconds gauge')
+        lines.append('patchtester_run_seconds %f' % (time.time() - self.started))
+        lines.append('# TYPE patchtester_last_update_timestamp_seconds gauge')
+        lines.append('patchtester_last_update_timestamp_seconds %f' % time.time())
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """
+            atomically replaces the textfile, if one was given
+        """
+        if not self.path:
+            return
+        self._written = time.time()
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as metrics_file:
+                metrics_file.write(self.render())
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            _logger.warning('Could not write metrics ' + str(e))
+
+    def maybeWrite(self):
+        """
+            writes the textfile if the interval has passed since the last
+        """
+        if self.path and time.time() - self._written >= self.interval:
+            self.write()
@@ -0,0 +1,168 @@
+'''
+Deadlines, retries and a circuit breaker around P4 commands.
+'''
+from contextlib import contextmanager
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+
+from patchtester.lazy import LazyModule
+
+P4 = LazyModule('P4')
+
+_logger = logging.getLogger(os.path.basename(sys.argv[0]))
+
+# seconds a command may run, by command name
+DEFAULT_TIMEOUTS = {
+    'sync': 4 * 60 * 60,
+    'integ': 30 * 60,
+    'resolve': 30 * 60,
+    'filelog': 10 * 60,
+    'describe': 10 * 60,
+}
+
+# messages of errors worth retrying
+TRANSIENT_ERRORS = (
+    'TCP receive failed',
+    'TCP send failed',
+    'Connect to server failed',
+    'Connection refused',
+    'Connection reset',
+    'Partner exited unexpectedly',
+    'Broken pipe',
+    'Server is shutting down',
+)
+
+# commands safe to run again after a transient error, they do not change
+# the server's state or, like sync, reach the same state when repeated
+RETRY_COMMANDS = ('describe', 'filelog', 'have', 'fstat', 'sync', 'verify',
+                  'opened', 'changes', 'files', 'print', 'info', 'where')
+
+
+class CommandTimeout(Exception):
+    """
+    A P4 command ran past its deadline, or an earlier command of the same
+    change did and its circuit is open.
+    """
+    def __init__(self, command, seconds, change=None):
+        self.command = command
+        self.seconds = seconds
+        self.change = change
+        Exception.__init__(self, 'p4 {0} did not finish within {1:.0f} seconds'
+                           .format(command, seconds))
+
+
+@functools.lru_cache(maxsize=None)
+def _deadlineClass():
+    """
+        returns the keep alive handler class, defined once P4 is loaded
+    """
+    class _Deadline(getattr(P4, 'PyKeepAlive', object)):
+        """
+        Keep alive handler asking the server to break a command past its
+        deadline.
+        """
+        def __init__(self, deadline):
+            self.deadline = deadline
+
+        def isAlive(self):
+            return 0 if time.time() > self.deadline else 1
+    return _Deadline
+
+
+class CommandPolicy(object):
+    """
+    Runs P4 commands with per-command timeouts, bounded retries with
+    exponential backoff for transient errors of read-only commands, and a
+    circuit breaker per changelist: once a command of a changelist times
+    out, every further command for that changelist fails at once.  When the run has a deadline
+    no command of a changelist runs past it.
+    """
+    def __init__(self, timeout=10 * 60, timeouts=None, retries=2, backoff=2.0,
+                 deadline=None, retry_commands=RETRY_COMMANDS):
+        self.timeout = timeout
+        self.timeouts = dict(DEFAULT_TIMEOUTS)
+        self.timeouts.update(timeouts or {})
+        self.retries = retries
+        self.backoff = backoff
+        self.deadline = deadline
+        self.retry_commands = frozenset(retry_commands)
+        self.open_circuits = set()
+        self._local = threading.local()
+
+    @contextmanager
+    def scope(self, change):
+        """
+            attributes the commands of the enclosed block to a changelist
+
+            @param change: the requested change being tested
+        """
+        previous = getattr(self._local, 'change', None)
+        self._local.change = str(change)
+        try:
+            yield
+        finally:
+            self._local.change = previous
+
+    def run(self, p4, args):
+        """
+            runs a command under the policy
+
+            @param p4: the connection
+            @param args: the command and arguments as passed to P4.run
+        """
+        command = args[0]
+        if isinstance(command, (list, tuple)):
+            command = command[0]
+        change = getattr(self._local, 'change', None)
+        seconds = self.timeouts.get(command, self.timeout)
+        if self.deadline is not None and change is not None:
+            seconds = max(0.0, min(seconds, self.deadline - time.time()))
+        if change in self.open_circuits:
+            raise CommandTimeout(command, seconds, change)
+
+        attempt = 0
+        while True:
+            deadline = time.time() + seconds
+            if hasattr(p4, 'setbreak'):
+                p4.setbreak(_deadlineClass()(deadline))
+            try:
+                return p4.run(*args)
+            except P4.P4Exception as e:
+                if time.time() > deadline:
+                    if change is not None:
+                        self.open_circuits.add(change)
+                    _logger.info('p4 {0} timed out after {1:.0f} seconds'
+                                 .format(command, seconds))
+                    raise CommandTimeout(command, seconds, change)
+                if (attempt >= self.retries or
+                        command not in self.retry_commands or
+                        not any(error in str(e) for error in TRANSIENT_ERRORS)):
+                    raise
+                attempt += 1
+                wait = self.backoff ** attempt
+                _logger.info('p4 {0} failed, retry {1} of {2} in {3} seconds'
+                             .format(command, attempt, self.retries, wait))
+                _logger.debug(str(e))
+                time.sleep(wait)
+                if not p4.connected():
+                    try:
+                        p4.connect()
+                    except P4.P4Exception as e:
+                        _logger.debug('reconnect failed ' + str(e))
+
+
+def parse_timeouts(value):
+    '''
+        parses "command=seconds,..." into a dict
+
+        @param value: the argument string
+    '''
+    timeouts = {}
+    for entry in value.split(','):
+        command, seconds = entry.split('=')
+        timeouts[command.strip()] = float(seconds)
+    return timeouts
@@ -0,0 +1,243 @@
+'''
+Streaming run of a target branch.
+
+Requests flow through fetch, plan, integrate, suggest and report stages
+connected by bounded queues.  A request is reported, and the P4 payloads of
+its changes released, as soon as its last change is done, so memory stays
+flat however many requests a run has.  A request a stage fails on is
+reported with the error on its changes and the stream goes on.
+'''
+from collections import defaultdict
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+from patchtester.mailer import address_of
+
+_logger = logging.getLogger(os.path.basename(sys.argv[0]))
+
+# requests buffered between two stages
+STREAM_DEPTH = 8
+
+# ends the requests of a stage
+_DONE = object()
+
+
+class Pipeline(object):
+    """
+    Streams requests through the stages of a run of one target branch.
+
+    Planning and conflict analysis run on their own connections, the
+    integrations on the connection of the PatchTester.
+    """
+    def __init__(self, pt, prescreen=False, depth=STREAM_DEPTH):
+        self.pt = pt
+        self.prescreen = prescreen
+        self.depth = depth
+        self.branch = pt.pt_data.branches[0]
+        self.requests = 0  # reported requests
+        self._stop = threading.Event()
+        self._errors = []
+        self._pool = None
+        self._owners = defaultdict(list)  # owner address: result offsets
+
+    def run(self, requests, spool, user_address, owner_reports=True,
+            history=None, run_id=None, results=None):
+        """
+            tests and reports the requests; the full report is written to
+            the spool while the requests are tested, the owner reports once
+            the last one is done
+
+            @param requests: iterable of (request id, owner, changes)
+            @param spool: the ReportSpool of the run
+            @param user_address: the recipient of the full report
+            @param owner_reports: spool the requests of every owner
+            @param history: the ResultsHistory the results are recorded in
+            @param run_id: the history run
+            @param results: the ResultsWriter of the run
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        pt = self.pt
+        pt.streaming = True
+        queues = [queue.Queue(self.depth) for _ in range(4)]
+        threads = [threading.Thread(target=self._fetch,
+                                    args=(requests, queues[0]),
+                                    name='fetch')]
+        for name, work, source, sink in (
+                ('plan', self._plan, queues[0], queues[1]),
+                ('integrate', self._integrate, queues[1], queues[2]),
+                ('suggest', self._suggest, queues[2], queues[3])):
+            threads.append(threading.Thread(target=self._stage,
+                                            args=(work, source, sink),
+                                            name=name))
+
+        from_prefix = pt.pt_data.p4_from_prefix
+        to_prefix = self.branch['p4_to_prefix']
+        owner_path = os.path.join(spool.directory, 'owners.jsonl')
+        diffs_p4 = pt.diffs and pt.diffs.p4
+        if pt.diffs:
+            # the report runs on this thread while self.p4 integrates
+            pt.diffs.p4 = pt.workerP4()
+        if results:
+            results.startBranch(self.branch)
+
+        self._pool = ThreadPoolExecutor(max_workers=max(1, pt.workers))
+        for thread in threads:
+            thread.start()
+        try:
+            with open(owner_path, 'w') as owner_file:
+                spool.add(user_address,
+                          self._reported(queues[3], history, run_id, results,
+                                         owner_file if owner_reports else None,
+                                         user_address),
+                          from_prefix, to_prefix)
+        except BaseException:
+            self._stop.set()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+            self._pool.shutdown()
+            pt.closeWorkers()
+            if pt.diffs:
+                pt.diffs.p4 = diffs_p4
+        if self._errors:
+            raise self._errors[0]
+
+        for address, offsets in self._owners.items():
+            spool.add(address, self._ownerResults(owner_path, offsets),
+                      from_prefix, to_prefix)
+        os.remove(owner_path)
+
+    def _put(self, sink, item):
+        # gives up once the pipeline stopped, the next stage may be gone
+        while not self._stop.is_set():
+            try:
+                sink.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, source):
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _fail(self, error):
+        _logger.exception('streaming stage failed')
+        self._errors.append(error)
+        self._stop.set()
+
+    def _fetch(self, requests, sink):
+        """
+            builds the nodes of the fetched requests and feeds them into
+            the pipeline
+        """
+        from anytree import Node
+
+        try:
+            for req_id, owner, changes in requests:
+                if self._stop.is_set():
+                    break
+                request = Node(req_id, req_id=req_id, owner=owner)
+                request.fetched = time.time()
+                for change in changes:
+                    Node(change, req_change=change, parent=request)
+                self._put(sink, request)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._put(sink, _DONE)
+
+    def _stage(self, work, source, sink):
+        """
+            runs a stage on every request until the previous one is done
+        """
+        try:
+            while True:
+                request = self._get(source)
+                if request is _DONE:
+                    break
+                if getattr(request, 'stream_error', None) is None:
+                    try:
+                        work(request)
+                    except Exception as e:
+                        _logger.exception('request {} failed'
+                                          .format(request.req_id))
+                        self.pt.failRequest(request, e)
+                self._put(sink, request)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._put(sink, _DONE)
+
+    def _plan(self, request):
+        """
+            plans the changes of a request
+        """
+        self.pt.planRequest(request, self.prescreen, self.pt.workerP4())
+
+    def _integrate(self, request):
+        """
+            tests the changes of a request
+        """
+        _logger.info("\nRequest {0}: {1} changes".format(
+                     request.req_id, len(request.children)))
+        request.conflicts = self.pt.integrateRequest(request)
+
+    def _suggest(self, request):
+        """
+            analyzes the conflicts of a request
+        """
+        conflicts = getattr(request, 'conflicts', None)
+        request.conflicts = None
+        if conflicts:
+            self.pt.suggestConflicts(conflicts, self._pool,
+                                     self.pt.workerP4())
+
+    def _reported(self, source, history, run_id, results, owner_file,
+                  user_address=None):
+        """
+            yields the results of the finished requests to the report,
+            recording and releasing each of them; the requests of owners
+            other than the user go to owner_file
+        """
+        pt = self.pt
+        name = self.branch['name']
+        while True:
+            request = self._get(source)
+            if request is _DONE:
+                return
+            req = pt.requestResult(request)
+            pt.metrics.recordResults(name, [req])
+            pt.metrics.observe('request', name, time.time() - request.fetched)
+            if history:
+                history.record(run_id, name, [req])
+            if results:
+                results.add(req)
+            if owner_file and req.get('owner'):
+                address = address_of(req['owner'])
+                if address != user_address:
+                    self._owners[address].append(owner_file.tell())
+                    owner_file.write(json.dumps(req) + '\n')
+            pt.releaseRequest(request)
+            self.requests += 1
+            yield req
+
+    @staticmethod
+    def _ownerResults(path, offsets):
+        """
+            yields the results of an owner's requests back from disk
+        """
+        with open(path) as owner_file:
+            for offset in offsets:
+                owner_file.seek(offset)
+                yield json.loads(owner_file.readline())
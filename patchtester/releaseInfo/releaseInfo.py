@@ -41,3 +41,11 @@ class ReleaseInfoCollection:
         """
         return self._releases.get(name)
 
+    def GetReleases(self):
+        """
+        Get all releases.
+
+        Returns:
+            dict: ReleaseInfo objects by release name
+        """
+        return dict(self._releases)
@@ -0,0 +1,83 @@
+'''
+Order in which the requested changes are integrated and the limits that end
+the testing of a run early.
+'''
+import heapq
+import time
+
+
+def risk_order(risks, files):
+    '''
+        returns the indexes of the changes riskiest first.  A change is only
+        scheduled after the earlier changes touching one of its files, the
+        workspace can not take a later revision of a file before the
+        earlier one.
+
+        @param risks: the risk of each change, in requested order
+        @param files: the depot files of each change, in requested order
+    '''
+    waiting = [0] * len(risks)  # earlier changes not scheduled yet
+    unblocks = [[] for _ in risks]
+    last = {}  # the latest change touching a file
+    for n, change_files in enumerate(files):
+        before = set(last[file] for file in change_files if file in last)
+        for m in before:
+            unblocks[m].append(n)
+        waiting[n] = len(before)
+        for file in change_files:
+            last[file] = n
+
+    ready = [(-risks[n], n) for n in range(len(risks)) if not waiting[n]]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        n = heapq.heappop(ready)[1]
+        order.append(n)
+        for m in unblocks[n]:
+            waiting[m] -= 1
+            if not waiting[m]:
+                heapq.heappush(ready, (-risks[m], m))
+    return order
+
+
+class RunBudget(object):
+    """
+    Number of failures and wall time after which a run stops testing
+    changes; the changes not tested are reported as skipped.
+    """
+    def __init__(self, max_failures=None, time_budget=None):
+        self.max_failures = max_failures
+        self.deadline = None
+        if time_budget:
+            self.deadline = time.time() + time_budget
+        self.failures = 0
+        self.stopped = None  # why testing stopped, once it did
+
+    def limited(self):
+        """
+            returns whether the run may be stopped early
+        """
+        return bool(self.max_failures) or self.deadline is not None
+
+    def failed(self):
+        """
+            counts a failed change
+        """
+        self.failures += 1
+
+    def expired(self):
+        """
+            returns whether the time budget is spent
+        """
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def exhausted(self):
+        """
+            returns why no further change is tested, None while they are
+        """
+        if self.max_failures and self.failures >= self.max_failures:
+            return ('{} failed changes reached the --max_failures limit'
+                    .format(self.failures))
+        if self.expired():
+            return 'the --time_budget was spent'
+        return None
@@ -0,0 +1,201 @@
+'''
+Deterministic splitting of a run over several hosts and merging of the
+shard results.
+'''
+import argparse
+import json
+import zlib
+
+
+def parse_shard(value):
+    '''
+        parses a "i/N" shard argument, shards are numbered from 1
+
+        @param value: the argument string
+    '''
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('shard must be given as i/N, e.g. 1/4')
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError('shard {} is not between 1 and {}'
+                                         .format(index, count))
+    return index, count
+
+
+def in_shard(key, index, count):
+    '''
+        returns whether a key belongs to a shard; the same key always goes
+        to the same shard on every host
+
+        @param key: the request id or change
+        @param index: the shard number starting at 1
+        @param count: the number of shards
+    '''
+    return zlib.crc32(str(key).encode('utf-8')) % count == index - 1
+
+
+def shard_tree(root, index, count):
+    '''
+        removes the requests of other shards from the request tree.
+        Requests keep all of their changes together; the changes of the
+        "local" request, which has no PRQ, are split one by one.
+
+        @param root: the root node of the request tree
+        @param index: the shard number starting at 1
+        @param count: the number of shards
+    '''
+    for request in list(root.children):
+        if request.req_id == 'local':
+            for integrate in list(request.children):
+                if not in_shard(integrate.req_change, index, count):
+                    integrate.parent = None
+            if not request.children:
+                request.parent = None
+        elif not in_shard(request.req_id, index, count):
+            request.parent = None
+
+    return [str(integrate.req_change) for request in root.children
+            for integrate in request.children]
+
+
+def shard_requests(requests, index, count):
+    '''
+        yields the fetched requests of a shard, split as shard_tree splits
+        the request tree
+
+        @param requests: (request id, owner, changes) of the fetched requests
+        @param index: the shard number starting at 1
+        @param count: the number of shards
+    '''
+    for req_id, owner, changes in requests:
+        if req_id == 'local':
+            changes = [change for change in changes
+                       if in_shard(change, index, count)]
+            if changes:
+                yield req_id, owner, changes
+        elif in_shard(req_id, index, count):
+            yield req_id, owner, changes
+
+
+class ResultsWriter(object):
+    """
+    Writes a results file for merging one request at a time, so a streamed
+    run does not hold its results.
+    """
+    def __init__(self, path, from_prefix, shard=None):
+        self._file = open(path, 'w')
+        self._file.write('{"from_prefix": %s, "shard": %s, "branches": ['
+                         % (json.dumps(from_prefix), json.dumps(shard)))
+        self._branches = 0
+        self._requests = 0
+
+    def startBranch(self, branch):
+        """
+            starts the results of a target branch
+
+            @param branch: the branch dict
+        """
+        if self._branches:
+            self._file.write(']}, ')
+        self._file.write('{"name": %s, "p4_to_prefix": %s, "results": ['
+                         % (json.dumps(branch['name']),
+                            json.dumps(branch['p4_to_prefix'])))
+        self._branches += 1
+        self._requests = 0
+
+    def add(self, req):
+        """
+            appends the result of a request to the current branch
+
+            @param req: a request of PatchTester.collectResults
+        """
+        if self._requests:
+            self._file.write(', ')
+        json.dump(req, self._file)
+        self._requests += 1
+
+    def close(self):
+        if self._branches:
+            self._file.write(']}')
+        self._file.write(']}')
+        self._file.close()
+
+
+def write_results(path, from_prefix, branches, shard=None):
+    '''
+        writes the collected results of a run for merging
+
+        @param path: the results file
+        @param from_prefix: the branch the changes were integrated from
+        @param branches: list of (branch dict, collected results)
+        @param shard: (i, N) of a sharded run
+    '''
+    writer = ResultsWriter(path, from_prefix, shard)
+    try:
+        for branch, results in branches:
+            writer.startBranch(branch)
+            for req in results:
+                writer.add(req)
+    finally:
+        writer.close()
+
+
+def merge_results(paths):  # NOQA - complexity accepted
+    '''
+        combines shard result files returning the from prefix and a list
+        of (branch dict, results) ordered as in the first file.  The
+        requests split over several shards, like "local", are joined again.
+        Raises ValueError when the files are from different source branches
+        or do not hold every shard of one run exactly once.
+
+        @param paths: the results files of every shard
+    '''
+    shards = []
+    for path in paths:
+        with open(path) as results_file:
+            data = json.load(results_file)
+        shard = data.get('shard')
+        shards.append((tuple(shard) if shard else None, path, data))
+
+    from_prefixes = set(data['from_prefix'] for shard, path, data in shards)
+    if len(from_prefixes) > 1:
+        raise ValueError('results are from different branches: ' +
+                         ', '.join(sorted(str(prefix)
+                                          for prefix in from_prefixes)))
+    if any(shard for shard, path, data in shards):
+        counts = set(shard and shard[1] for shard, path, data in shards)
+        if len(counts) > 1 or None in counts:
+            raise ValueError('results are not from shards of one run')
+        count = counts.pop()
+        seen = {}
+        for shard, path, data in shards:
+            if shard[0] in seen:
+                raise ValueError('shard {0}/{1} is in both {2} and {3}'
+                                 .format(shard[0], count, seen[shard[0]],
+                                         path))
+            seen[shard[0]] = path
+        missing = [str(index) for index in range(1, count + 1)
+                   if index not in seen]
+        if missing:
+            raise ValueError('missing results of shard {0} of {1}'
+                             .format(', '.join(missing), count))
+        shards.sort(key=lambda entry: entry[0])
+
+    merged = {}
+    for shard, path, data in shards:
+        for branch in data['branches']:
+            entry = merged.setdefault(branch['p4_to_prefix'],
+                                      (dict(name=branch['name'],
+                                            p4_to_prefix=branch['p4_to_prefix']),
+                                       {}))
+            for req in branch['results']:
+                if req['req_id'] in entry[1]:
+                    entry[1][req['req_id']]['changes'].extend(req['changes'])
+                else:
+                    entry[1][req['req_id']] = req
+
+    return (from_prefixes.pop() if from_prefixes else None,
+            [(branch, sorted(requests.values(),
+                             key=lambda req: str(req['req_id'])))
+             for branch, requests in merged.values()])
@@ -0,0 +1,13 @@
+'''
+Test setup: termutils is an in-house package that is not on PyPI, a minimal
+stand-in is registered when it is not installed.
+'''
+import sys
+import types
+
+try:
+    import termutils  # NOQA
+except ImportError:
+    termutils = types.ModuleType('termutils')
+    termutils.AskYesNo = lambda question: False
+    sys.modules['termutils'] = termutils
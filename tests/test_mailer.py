@@ -0,0 +1,154 @@
+'''
+Delivery of spooled reports to an in-process SMTP sink.
+'''
+import email
+import gzip
+import os
+import socketserver
+import threading
+
+import pytest
+
+from patchtester.mailer import ReportSpool, send_reports
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough SMTP for smtplib, storing each message on the server.
+    """
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        server = self.server
+        self.reply('220 sink ready')
+        recipients = []
+        while True:
+            line = self.rfile.readline().decode().rstrip('\r\n')
+            if not line:
+                return
+            command = line.split(' ', 1)[0].upper()
+            if command in ('EHLO', 'HELO'):
+                self.reply('250 sink')
+            elif command == 'MAIL':
+                recipients = []
+                self.reply('250 ok')
+            elif command == 'RCPT':
+                address = line.split(':', 1)[1].strip(' <>')
+                if address in server.refused:
+                    self.reply('550 no such user')
+                    continue
+                recipients.append(address)
+                self.reply('250 ok')
+            elif command == 'DATA':
+                self.reply('354 go ahead')
+                data = []
+                while True:
+                    line = self.rfile.readline().decode()
+                    if line in ('.\r\n', ''):
+                        break
+                    data.append(line[1:] if line.startswith('..') else line)
+                server.messages.append(
+                    (recipients, email.message_from_string(''.join(data))))
+                self.reply('250 queued')
+                if server.drop_after and \
+                        len(server.messages) % server.drop_after == 0:
+                    # hang up without a QUIT like a restarting server
+                    return
+            elif command == 'RSET':
+                self.reply('250 ok')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 not implemented')
+
+
+@pytest.fixture
+def sink():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _SMTPHandler)
+    server.daemon_threads = True
+    server.messages = []
+    server.refused = set()
+    server.drop_after = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def _request(req_id, owner, result='SUCCESS', details='integrated'):
+    return dict(req_id=req_id, owner=owner,
+                changes=[dict(orig_change=req_id[-4:], result=result,
+                              prescreen=None, sugs=None, details=details,
+                              error_keys=[], components=[])])
+
+
+@pytest.fixture
+def spool(tmp_path):
+    long_details = 'conflict in //to/big.c<br/>' * 50
+    requests = [_request('PRQ-1001', 'alice'),
+                _request('PRQ-1002', 'bob', 'FAILED', long_details)]
+    spool = ReportSpool(str(tmp_path), section_limit=200)
+    spool.add('me@example.com', requests, '//from', '//to')
+    for req in requests:
+        spool.add(req['owner'] + '@example.com', [req], '//from', '//to')
+    spool.long_details = long_details
+    return spool
+
+
+def _parts(message):
+    html = None
+    attachments = {}
+    for part in message.walk():
+        if part.get_content_type() == 'text/html':
+            html = part.get_payload(decode=True).decode()
+        elif part.get_filename():
+            attachments[part.get_filename()] = part.get_payload(decode=True)
+    return html, attachments
+
+
+def test_one_message_per_owner(sink, spool):
+    send_reports(spool, 'report', *sink.server_address,
+                 sender='me@example.com')
+
+    by_address = dict((recipients[0], message)
+                      for recipients, message in sink.messages)
+    assert sorted(by_address) == ['alice@example.com', 'bob@example.com',
+                                  'me@example.com']
+
+    html, attachments = _parts(by_address['alice@example.com'])
+    assert 'PRQ-1001' in html and 'PRQ-1002' not in html
+    assert not attachments
+
+    html, attachments = _parts(by_address['bob@example.com'])
+    assert 'PRQ-1002' in html and 'PRQ-1001' not in html
+    assert 'truncated' in html
+    details_name = os.path.basename(spool.detailsPath('bob@example.com'))
+    details = gzip.decompress(attachments[details_name])
+    assert spool.long_details in details.decode()
+
+    html, attachments = _parts(by_address['me@example.com'])
+    assert 'PRQ-1001' in html and 'PRQ-1002' in html
+    assert list(attachments) == [
+        os.path.basename(spool.detailsPath('me@example.com'))]
+
+
+def test_refused_recipient_keeps_the_session(sink, spool, caplog):
+    sink.refused.add('alice@example.com')
+    send_reports(spool, 'report', *sink.server_address,
+                 sender='me@example.com')
+
+    assert sorted(recipients[0] for recipients, message in sink.messages) == \
+        ['bob@example.com', 'me@example.com']
+    assert spool.path('alice@example.com') in caplog.text
+
+
+def test_reconnects_when_the_server_hangs_up(sink, spool):
+    sink.drop_after = 1
+    send_reports(spool, 'report', *sink.server_address,
+                 sender='me@example.com')
+
+    assert len(sink.messages) == 3
@@ -0,0 +1,220 @@
+'''
+Streaming pipeline runs against a fake P4 server.
+'''
+import itertools
+import threading
+import types
+
+import pytest
+from anytree import Node
+
+import patchtester
+import patchtester.p4policy
+from patchtester.mailer import ReportSpool
+from patchtester.pipeline import Pipeline
+
+
+class FakeP4Exception(Exception):
+    pass
+
+
+class FakeP4(object):
+    """
+    A connection to a depot where change N edits //from/fN%3 and a resolve
+    of //to/f1 conflicts.  A command named in fail raises a RuntimeError
+    when one of its arguments contains the text listed with it.
+    """
+    RAISE_ERRORS = 1
+    created = itertools.count(9000)
+    integrated = {}  # pending change: the change integrated into it
+
+    def __init__(self, client='client', port='port', user='user', fail=None,
+                 commands=None):
+        self.client, self.port, self.user = client, port, user
+        self.fail = fail or {}
+        self.commands = commands if commands is not None else []
+        self.thread = None
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def connected(self):
+        return True
+
+    def setbreak(self, keepalive):
+        pass
+
+    def fetch_change(self):
+        return {}
+
+    def at_exception_level(self, level):
+        return _NoContext()
+
+    def run(self, *args):
+        if isinstance(args[0], list):
+            args = args[0]
+        thread = threading.current_thread()
+        self.thread = self.thread or thread
+        assert self.thread is thread, 'connection shared between threads'
+        self.commands.append(args)
+        command = args[0]
+        for text in self.fail.get(command, ()):
+            if any(text in str(arg) for arg in args[1:]):
+                raise RuntimeError('p4 {} broke'.format(command))
+        if command == 'integ':
+            self.integrated[args[3]] = int(args[5].rsplit(',', 1)[1])
+        if command == 'describe':
+            change = int(args[-1])
+            if change >= 9000:
+                change = self.integrated[str(change)]
+                return [{'change': args[-1], 'status': 'pending',
+                         'depotFile': ['//to/f{}'.format(change % 3)],
+                         'rev': ['2'], 'action': ['integrate']}]
+            return [{'change': str(change), 'desc': 'edit', 'status':
+                     'submitted', 'path': '//from/...',
+                     'depotFile': ['//from/f{}'.format(change % 3)],
+                     'rev': ['2'], 'action': ['edit']}]
+        if command == 'change':
+            return ['Change {} created.'.format(next(self.created))]
+        if command == 'resolve':
+            if args[-1].endswith('f1'):
+                return [{'clientFile': '/ws/f1', 'fromFile': '//from/f1',
+                         'baseFile': '//from/f1', 'how': 'merge',
+                         'startFromRev': '1', 'endFromRev': '2',
+                         'baseRev': '1'},
+                        'Diff chunks: 0 yours + 1 theirs + 0 both'
+                        ' + 1 conflicting']
+            return [{'how': 'copy from'}]
+        if command == 'filelog' and '-h' in args:
+            return [{'file': [['//from/f1']], 'how': [['copy from']],
+                     'action': ['integrate'], 'change': ['123']}]
+        if command == 'have':
+            return [{'depotFile': file, 'haveRev': '1'} for file in args[1:]]
+        return []
+
+
+class _NoContext(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+class _Results(object):
+    """
+    Collects what the pipeline hands to a ResultsWriter.
+    """
+    def __init__(self):
+        self.requests = []
+
+    def startBranch(self, branch):
+        pass
+
+    def add(self, req):
+        self.requests.append(req)
+
+
+@pytest.fixture
+def run(monkeypatch, tmp_path):
+    """
+        returns a function streaming requests through a Pipeline, giving
+        the reported results by request id and the commands run
+    """
+    def stream(requests, fail=None):
+        commands = []
+
+        class Connection(FakeP4):
+            def __init__(self, **kwargs):
+                FakeP4.__init__(self, fail=fail, commands=commands, **kwargs)
+
+        fake = types.SimpleNamespace(P4=Connection,
+                                     P4Exception=FakeP4Exception)
+        monkeypatch.setattr(patchtester, 'P4', fake)
+        monkeypatch.setattr(patchtester.p4policy, 'P4', fake)
+
+        data = Node('root')
+        data.p4 = Connection()
+        data.p4_from_prefix = '//from'
+        data.branches = [{'name': 'beta', 'p4_to_prefix': '//to'}]
+        data.created_changelists = []
+        data.workers = 2
+        pt = patchtester.PatchTester(data, 0)
+        results = _Results()
+        pipeline = Pipeline(pt, prescreen=True)
+        stream.spool = ReportSpool(str(tmp_path))
+        pipeline.run(requests, stream.spool, 'me@example.com',
+                     results=results)
+        assert pipeline.requests == len(requests)
+        reported = dict((req['req_id'], req) for req in results.requests)
+        return reported, commands
+    return stream
+
+
+@pytest.mark.parametrize('stage, command, text', [
+    ('plan', 'describe', '1000'),
+    ('integrate', 'integ', '@1000'),
+    # only the conflict analysis runs filelog -h
+    ('suggest', 'filelog', '-h')])
+def test_failing_stage_fails_only_its_request(run, stage, command, text):
+    # 1000 edits //from/f1, the only file whose resolve conflicts
+    requests = [('PRQ-1', 'alice', ['1004']),
+                ('PRQ-2', 'bob', ['1000']),
+                ('PRQ-3', 'carol', ['1002', '1005'])]
+    reported, commands = run(requests, fail={command: [text]})
+
+    assert list(reported) == ['PRQ-1', 'PRQ-2', 'PRQ-3']
+    integrated = [args for args in commands
+                  if args[0] == 'integ' and '@1000,' in args[5]]
+    assert bool(integrated) == (stage != 'plan')
+    failed = reported['PRQ-2']['changes'][0]
+    assert failed['result'] == 'FAILED'
+    assert 'patchtester error' in failed['details']
+    assert 'p4 {} broke'.format(command) in failed['details']
+    for req_id in ('PRQ-1', 'PRQ-3'):
+        for chg in reported[req_id]['changes']:
+            assert chg['result'] == 'SUCCESS'
+
+
+def test_failed_request_fills_in_its_conflicts(run):
+    requests = [('PRQ-1', 'alice', ['1000', '1002'])]
+    reported, commands = run(requests, fail={'integ': ['@1002']})
+
+    conflicted = reported['PRQ-1']['changes'][0]
+    assert conflicted['result'] == 'FAILED'
+    assert 'None' not in conflicted['sugs']
+    assert 'Analysis of this conflict did not run' in conflicted['sugs']
+
+
+def test_duplicate_changes_are_tested_once(run):
+    requests = [('PRQ-1', 'alice', ['1000', '1002']),
+                ('PRQ-2', 'bob', ['1002']),
+                ('PRQ-3', 'carol', ['1005', '1000'])]
+    reported, commands = run(requests)
+
+    integrated = [args for args in commands if args[0] == 'integ']
+    assert len(integrated) == 3
+
+    first = dict((chg['orig_change'], chg)
+                 for chg in reported['PRQ-1']['changes'])
+    assert first['1000']['result'] == 'FAILED'
+    assert first['1000']['sugs']
+    assert first['1002']['result'] == 'SUCCESS'
+    assert reported['PRQ-2']['changes'][0] == first['1002']
+    assert reported['PRQ-3']['changes'][0]['result'] == 'SUCCESS'
+    assert reported['PRQ-3']['changes'][1] == first['1000']
+
+
+def test_own_requests_are_reported_once(run):
+    requests = [('PRQ-1', 'me', ['1002']),
+                ('PRQ-2', 'alice', ['1004'])]
+    run(requests)
+
+    reports = dict((address, path)
+                   for address, path, details in run.spool.reports())
+    assert sorted(reports) == ['alice@example.com', 'me@example.com']
+    with open(reports['me@example.com']) as report_file:
+        assert report_file.read().count('Request: PRQ-1') == 1
@@ -0,0 +1,145 @@
+'''
+Splitting of a run into shards and merging of the shard results.
+'''
+import json
+
+import pytest
+from anytree import Node
+
+from patchtester.shards import (merge_results, shard_requests, shard_tree,
+                                write_results)
+
+REQUESTS = [('PRQ-{}'.format(n), 'owner{}'.format(n % 3),
+             [str(1000 + n), str(2000 + n)]) for n in range(20)] + \
+           [('local', None, [str(3000 + n) for n in range(10)])]
+
+BRANCH = {'name': 'beta', 'p4_to_prefix': '//to'}
+
+
+def _tree(requests):
+    root = Node('root')
+    for req_id, owner, changes in requests:
+        request = Node(req_id, req_id=req_id, owner=owner, parent=root)
+        for change in changes:
+            Node(change, req_change=change, parent=request)
+    return root
+
+
+def _result(req_id, changes):
+    return {'req_id': req_id, 'owner': None,
+            'changes': [{'orig_change': change, 'result': 'SUCCESS'}
+                        for change in changes]}
+
+
+def _write_shards(tmp_path, count, from_prefix='//from'):
+    paths = []
+    for index in range(1, count + 1):
+        path = str(tmp_path / 'shard{}.json'.format(index))
+        results = [_result(req_id, changes) for req_id, owner, changes
+                   in shard_requests(REQUESTS, index, count)]
+        write_results(path, from_prefix, [(BRANCH, results)],
+                      shard=(index, count))
+        paths.append(path)
+    return paths
+
+
+def test_shards_split_every_change_once():
+    count = 4
+    shards = [list(shard_requests(REQUESTS, index, count))
+              for index in range(1, count + 1)]
+
+    assert shards == [list(shard_requests(REQUESTS, index, count))
+                      for index in range(1, count + 1)]
+    assert all(shards)
+    req_ids = [req_id for shard in shards for req_id, owner, changes in shard
+               if req_id != 'local']
+    assert sorted(req_ids) == sorted(req_id for req_id, owner, changes
+                                     in REQUESTS if req_id != 'local')
+    # a request keeps its changes together, local is split by change
+    for shard in shards:
+        for req_id, owner, changes in shard:
+            if req_id != 'local':
+                assert changes == dict((r[0], r[2]) for r in REQUESTS)[req_id]
+    local = [change for shard in shards for req_id, owner, changes in shard
+             if req_id == 'local' for change in changes]
+    assert sorted(local) == REQUESTS[-1][2]
+    assert sum(1 for shard in shards for req_id, owner, changes in shard
+               if req_id == 'local') > 1
+
+
+@pytest.mark.parametrize('index', [1, 2, 3])
+def test_shard_tree_matches_shard_requests(index):
+    root = _tree(REQUESTS)
+    integrates = shard_tree(root, index, 3)
+
+    expected = list(shard_requests(REQUESTS, index, 3))
+    assert [(request.req_id, [str(integrate.req_change)
+                              for integrate in request.children])
+            for request in root.children] == \
+        [(req_id, changes) for req_id, owner, changes in expected]
+    assert integrates == [change for req_id, owner, changes in expected
+                          for change in changes]
+
+
+def test_merge_joins_the_shards(tmp_path):
+    from_prefix, branches = merge_results(_write_shards(tmp_path, 3))
+
+    assert from_prefix == '//from'
+    assert len(branches) == 1
+    branch, requests = branches[0]
+    assert branch == BRANCH
+    assert [req['req_id'] for req in requests] == \
+        sorted(req_id for req_id, owner, changes in REQUESTS)
+    merged = dict((req['req_id'], req) for req in requests)
+    for req_id, owner, changes in REQUESTS:
+        assert sorted(chg['orig_change'] for chg
+                      in merged[req_id]['changes']) == sorted(changes)
+
+
+def test_merge_of_unsharded_results(tmp_path):
+    path = str(tmp_path / 'results.json')
+    results = [_result(req_id, changes) for req_id, owner, changes in REQUESTS]
+    write_results(path, '//from', [(BRANCH, results)])
+
+    from_prefix, branches = merge_results([path])
+    assert from_prefix == '//from'
+    assert branches[0][1] == sorted(results, key=lambda req: req['req_id'])
+
+
+def test_merge_needs_every_shard(tmp_path):
+    paths = _write_shards(tmp_path, 3)
+
+    with pytest.raises(ValueError, match='missing results of shard 2 of 3'):
+        merge_results([paths[0], paths[2]])
+
+
+def test_merge_refuses_a_shard_twice(tmp_path):
+    paths = _write_shards(tmp_path, 2)
+    copy = str(tmp_path / 'copy.json')
+    with open(paths[0]) as source, open(copy, 'w') as target:
+        json.dump(json.load(source), target)
+
+    with pytest.raises(ValueError, match='shard 1/2 is in both'):
+        merge_results(paths + [copy])
+
+
+def test_merge_refuses_mixed_results(tmp_path):
+    paths = _write_shards(tmp_path, 2)
+    unsharded = str(tmp_path / 'results.json')
+    write_results(unsharded, '//from', [(BRANCH, [])])
+    (tmp_path / 'other').mkdir()
+    other_run = _write_shards(tmp_path / 'other', 3)
+
+    with pytest.raises(ValueError, match='not from shards of one run'):
+        merge_results(paths + [unsharded])
+    with pytest.raises(ValueError, match='not from shards of one run'):
+        merge_results(paths + other_run[:1])
+
+
+def test_merge_refuses_other_source_branches(tmp_path):
+    paths = _write_shards(tmp_path, 2)
+    (tmp_path / 'other').mkdir()
+    other = _write_shards(tmp_path / 'other', 2, from_prefix='//other')
+
+    with pytest.raises(ValueError, match='results are from different'):
+        merge_results([paths[0], other[1]])